@@ -0,0 +1,263 @@
+#!/usr/bin/python
+"""
+Benchmarks for csvmod on synthetic feeds.
+
+Generates a feed and a join file, then times ``CSVMod.start`` end to end and
+each stage of the row loop separately (parse, create_row, handle, joins,
+statistics, write). Every scenario runs in its own process, so the reported
+peak RSS belongs to that scenario alone.
+
+    python bench.py --rows 200000 --strategy scan hash --output results.json
+    python bench.py --rows 200000 --compare results.json
+"""
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import string
+import sys
+import tempfile
+import time
+
+from csvmod import CSVMod, Controller, JoinCSV, Profiler, Statistics, comma_decimal, comma_decimal_formatter, peak_rss_kb
+
+STAGES = ("parse", "create_row", "handle", "joins", "statistics", "write")
+
+
+def make_keys(n, cardinality, distribution, order, rnd):
+    """
+    Return ``n`` join keys drawn from ``cardinality`` distinct values.
+
+    :param distribution: "uniform", "zipf" (few hot keys) or "sequential"
+    :param order: "random" or "sorted"
+    """
+    if distribution == "sequential":
+        keys = [i % cardinality for i in range(n)]
+    elif distribution == "zipf":
+        weights = [1.0 / (i + 1) for i in range(cardinality)]
+        keys = rnd.choices(range(cardinality), weights, k=n)
+    elif distribution == "uniform":
+        keys = [rnd.randrange(cardinality) for _ in range(n)]
+    else:
+        raise ValueError("Unknown key distribution: %s" % distribution)
+
+    if order == "sorted":
+        keys.sort()
+    elif order == "random":
+        if distribution == "sequential":
+            rnd.shuffle(keys)
+    else:
+        raise ValueError("Unknown key order: %s" % order)
+
+    return keys
+
+
+def generate_feed(file_name, rows, columns, join_rows, distribution="uniform", order="random", seed=0):
+    """
+    Write a feed with an ``Key`` join column, ``Price``/``Shipping`` comma
+    decimals and ``columns`` - 3 filler text columns.
+    """
+    rnd = random.Random(seed)
+    filler = ["Col%d" % i for i in range(max(columns - 3, 0))]
+    keys = make_keys(rows, join_rows, distribution, order, rnd)
+
+    with open(file_name, "w", encoding="utf-8", newline="") as f:
+        f.write(";".join(["Key", "Price", "Shipping"] + filler) + "\n")
+
+        for key in keys:
+            values = ["K%08d" % key, "%d,%02d" % (rnd.randrange(100), rnd.randrange(100)), "4,90"]
+            values.extend("".join(rnd.choices(string.ascii_letters, k=8)) for _ in filler)
+            f.write(";".join(values) + "\n")
+
+
+def generate_join(file_name, rows, order="sorted", seed=0):
+    """
+    Write a join file with one row per key ``K00000000`` .. ``rows - 1``.
+    """
+    rnd = random.Random(seed)
+    keys = list(range(rows))
+
+    if order == "random":
+        rnd.shuffle(keys)
+
+    with open(file_name, "w", encoding="utf-8", newline="") as f:
+        f.write("Key;Name\n")
+        for key in keys:
+            f.write("K%08d;Name %d\n" % (key, key))
+
+
+def make_controller(feed, join_file, output_file, strategy, **reader_options):
+    class BenchController(Controller):
+        statistics = [Statistics()]
+        settings = dict(
+            file=feed,
+            converter={"Price": comma_decimal, "Shipping": comma_decimal},
+            # not shared, every run has to build its own index to be comparable
+            joins=(JoinCSV(name="ref", file=join_file, local="Key", remote="Key", fields=("Name", ),
+                           strategy=strategy, shared=False), ),
+            **reader_options
+        )
+        output = dict(
+            file=output_file,
+            fields=("Key", "Price", "Shipping", "Name"),
+            formatter={"Price": comma_decimal_formatter, "Shipping": comma_decimal_formatter},
+        )
+
+        def handle(self, data):
+            if data["Price"] >= 40:
+                data["Price"] = data["Price"] + data["Shipping"]
+                data["Shipping"] = 0
+
+            data["Name"] = data.join("ref", "Name")
+
+    return BenchController()
+
+
+def time_end_to_end(controller):
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        CSVMod(controller).start()
+        return time.perf_counter() - start
+
+
+def time_stages(controller) -> dict:
+    """
+    Run ``CSVMod.start`` with a ``Profiler`` attached. Join lookups are timed
+    inside ``handle`` and reported separately.
+    """
+    profiler = Profiler()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        CSVMod(controller, profiler=profiler).start()
+
+    report = profiler.report()
+    timings = {stage: report["stages"].get(stage, dict(seconds=0.0))["seconds"] for stage in STAGES}
+    timings["joins"] = sum(join["seconds"] for join in report["joins"].values())
+    timings["handle"] -= timings["joins"]
+
+    return timings
+
+
+def run_scenario(scenario: dict) -> dict:
+    tmp = scenario["dir"]
+    output = os.path.join(tmp, "output.csv")
+    options = scenario.get("reader_options", dict())
+    best = None
+
+    for _ in range(scenario["repeat"]):
+        seconds = time_end_to_end(make_controller(scenario["feed"], scenario["join"], output,
+                                                  scenario["strategy"], **options))
+        best = seconds if best is None else min(best, seconds)
+
+    stages = time_stages(make_controller(scenario["feed"], scenario["join"], output, scenario["strategy"], **options))
+
+    return dict(
+        name=scenario["name"],
+        seconds=best,
+        rows_per_second=scenario["rows"] / best if best else None,
+        stages=stages,
+        peak_rss_kb=peak_rss_kb(),
+    )
+
+
+def _run_isolated(scenario: dict) -> dict:
+    import multiprocessing
+
+    with multiprocessing.get_context("fork").Pool(1) as pool:
+        return pool.apply(run_scenario, (scenario, ))
+
+
+def run_benchmark(rows=100000, columns=20, join_rows=10000, distribution="uniform", order="random",
+                  strategies=("scan", "hash"), repeat=3, mmap=False, seed=0, isolated=True) -> dict:
+    """
+    Generate the input files once and run one scenario per join strategy.
+    Returns a JSON serialisable result.
+    """
+    if "merge" in strategies and order != "sorted":
+        raise ValueError("The merge strategy needs --order sorted")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        feed = os.path.join(tmp, "feed.csv")
+        join = os.path.join(tmp, "join.csv")
+
+        generate_feed(feed, rows, columns, join_rows, distribution, order, seed)
+        generate_join(join, join_rows, "sorted" if order == "sorted" else "random", seed)
+
+        results = list()
+        for strategy in strategies:
+            scenario = dict(name=strategy + ("+mmap" if mmap else ""), dir=tmp, feed=feed, join=join, rows=rows,
+                            strategy=strategy, repeat=repeat, reader_options=dict(mmap=True) if mmap else dict())
+            results.append(_run_isolated(scenario) if isolated else run_scenario(scenario))
+
+    return dict(
+        python=platform.python_version(),
+        platform=platform.platform(),
+        parameters=dict(rows=rows, columns=columns, join_rows=join_rows, distribution=distribution,
+                        order=order, repeat=repeat, mmap=mmap, seed=seed),
+        scenarios=results,
+    )
+
+
+def print_report(result: dict, baseline: dict=None, threshold=0.1) -> bool:
+    """
+    Print the results, compared to ``baseline`` if given. Returns False if a
+    scenario got more than ``threshold`` slower than in the baseline.
+    """
+    before = {s["name"]: s for s in (baseline or dict()).get("scenarios", ())}
+    ok = True
+
+    print("%-12s %10s %12s %10s  %s" % ("scenario", "seconds", "rows/s", "rss (MB)", " ".join(
+        "%10s" % stage for stage in STAGES)))
+
+    for scenario in result["scenarios"]:
+        print("%-12s %10.3f %12.0f %10.1f  %s" % (
+            scenario["name"], scenario["seconds"], scenario["rows_per_second"], scenario["peak_rss_kb"] / 1024,
+            " ".join("%10.3f" % scenario["stages"][stage] for stage in STAGES)))
+
+        old = before.get(scenario["name"])
+        if old is not None:
+            change = scenario["seconds"] / old["seconds"] - 1
+            print("%-12s %+9.1f%% vs. baseline" % ("", change * 100))
+
+            if change > threshold:
+                ok = False
+
+    return ok
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Benchmark csvmod on synthetic feeds.")
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--columns", type=int, default=20)
+    parser.add_argument("--join-rows", type=int, default=10000)
+    parser.add_argument("--distribution", choices=("uniform", "zipf", "sequential"), default="uniform")
+    parser.add_argument("--order", choices=("random", "sorted"), default="random")
+    parser.add_argument("--strategy", nargs="+", default=["scan", "hash"], choices=JoinCSV.strategies)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--mmap", action="store_true", help="read the feed with mmap")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="relative slowdown that counts as a regression (default: 0.1)")
+    args = parser.parse_args()
+
+    result = run_benchmark(args.rows, args.columns, args.join_rows, args.distribution, args.order,
+                           args.strategy, args.repeat, args.mmap, args.seed)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    ok = print_report(result, baseline, args.threshold)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+    sys.exit(0 if ok else 1)
@@ -1,5 +1,19 @@
 #!/usr/bin/python
 import csv
+import io
+import os
+import sys
+import time
+from collections import OrderedDict
+from itertools import compress, islice, repeat
+from operator import itemgetter
+
+if __name__ == "__main__":
+    # hand over to the importable module before defining anything, so the module body runs once and controllers
+    # importing csvmod share its classes
+    import csvmod
+
+    sys.exit(csvmod.main())
 
 
 def comma_decimal(val):
@@ -10,6 +24,17 @@ def comma_decimal_formatter(val):
     return str(val).replace(".", ",")
 
 
+def _text_converter(converter):
+    """
+    Wrap ``converter`` to pass values that are not strings, like the typed
+    values of Parquet and Arrow files, through unchanged.
+    """
+    def convert(value):
+        return converter(value) if isinstance(value, str) else value
+
+    return convert
+
+
 class CSVError(Exception):
     pass
 
@@ -30,16 +55,170 @@ class CSVFieldError(CSVError):
 
 
 class CSVMod(object):
-    def __init__(self, controller):
+    def __init__(self, controller, incremental=None, checkpoint=None, resume=False, profiler=None):
+        """
+        :param incremental: path of a state file. If given, rows whose
+            ``Controller.primary_key`` and content are unchanged since the
+            previous run with the same controller and join files are not
+            handled again, the previous output is reused instead.
+        :param checkpoint: path or ``Checkpoint`` to periodically save the
+            progress to. It is removed when the run completes.
+        :param resume: continue from the checkpoint instead of starting over.
+        :param profiler: a ``Profiler`` recording time per stage and join.
+        """
         self.controller = controller
+        self.incremental = incremental
+        self.checkpoint = Checkpoint(checkpoint) if isinstance(checkpoint, str) else checkpoint
+        self.resume = resume
+        self.profiler = profiler
+
+        if resume and self.checkpoint is None:
+            raise CSVError("Resuming requires a checkpoint")
+
+    def start(self, processes=1):
+        """
+        Process the whole input file. With ``processes`` > 1 the input is split
+        into byte ranges that are handled by a pool of worker processes, see
+        ``start_parallel()``.
+        """
+        if processes > 1 and (self.incremental or self.checkpoint or self.profiler):
+            raise CSVError("Incremental, checkpointed and profiled runs are not supported with multiple processes")
+
+        try:
+            if processes > 1:
+                self.start_parallel(processes)
+            else:
+                self.run()
+        except BaseException:
+            self.controller.close()
+
+            if self.profiler is not None:
+                self.profiler.uninstall()
+            raise
+
+        if self.checkpoint is not None:
+            self.checkpoint.remove()
+
+        self.controller.finish()
+
+        if self.profiler is not None:
+            self.profiler.finish()
+
+    def start_parallel(self, processes):
+        """
+        Split the input file on record boundaries and run each part through a
+        fresh instance of the controller class in a process pool. The parts are
+        written to temporary files next to the output and concatenated in input
+        order, statistics and join counters of all workers are merged into this
+        controller before ``finish()``.
+
+        Controller state is per worker, so handlers must not depend on rows
+        seen earlier in the file.
+        """
+        import multiprocessing
+
+        controller = self.controller
+        reader = controller.reader
+
+        if not reader.fields:
+            reader.fields = reader.fieldnames
+
+        writer = controller.writer
+
+        # build the offset indexes once here, so the workers only open them
+        for join in walk_joins(reader.joins):
+            if join.strategy in ("disk", "index"):
+                join.build_offset_index()
+
+        jobs = list()
+        for i, (start, end) in enumerate(reader.byte_ranges(processes)):
+            part = "%s.part%d" % (writer.file_name, i)
+            jobs.append((type(controller), reader.file_name, part, start, end))
+
+        try:
+            with multiprocessing.Pool(processes) as pool:
+                results = pool.map(_parallel_worker, jobs)
 
-    def start(self):
+            writer.writeheader()
+
+            for job in jobs:
+                if os.path.exists(job[2]):
+                    writer.append_file(job[2])
+
+            writer.end()
+        finally:
+            for job in jobs:
+                if os.path.exists(job[2]):
+                    os.remove(job[2])
+
+        for statistics, join_stats in results:
+            for stat, other in zip(controller.statistics, statistics):
+                stat.merge(other)
+
+            for join, counter in zip(walk_joins(reader.joins), join_stats):
+                join.stats.merge(counter)
+
+    def run(self, header=True):
+        """
+        Read, handle and write every row of the controller's input without
+        finishing the controller.
+        """
         reader = self.controller.reader
+        state = None
+
+        if self.checkpoint is not None:
+            if self.incremental or getattr(self.controller, "handle_batch", None) is not None:
+                raise CSVError("Checkpoints are not supported for incremental runs or handle_batch")
+
+            if self.resume:
+                state = self.checkpoint.load(reader)
+                reader.byte_range = (state["input_offset"], None)
+            elif reader.byte_range is None:
+                reader.byte_range = (0, None)
+
         reader.begin()
 
+        # the writer takes the reader's fields, which begin() sets if the controller selects no fields
         writer = self.controller.writer
         writer.begin()
-        writer.writeheader()
+
+        if self.profiler is not None:
+            self.profiler.install(self.controller, reader, writer)
+
+        if state is not None:
+            writer.resume(state["output_offset"])
+            self.checkpoint.restore(self.controller, state)
+        elif header:
+            writer.writeheader()
+
+        if getattr(self.controller, "handle_batch", None) is not None:
+            if self.incremental:
+                raise CSVError("Incremental runs are not supported with handle_batch")
+
+            return self.run_batches(reader, writer)
+
+        if self.incremental:
+            return self.run_incremental(reader, writer)
+
+        if self.checkpoint is not None:
+            return self.run_checkpointed(reader, writer)
+
+        for row in reader.rows():
+            update = self.controller.handle(row)
+            self.controller.post_progress(row)
+
+            if update is None:
+                update = row.is_changed
+
+            if update:
+                writer.write(row.fields)
+
+    def run_checkpointed(self, reader, writer):
+        """
+        Like ``run()``, saving a checkpoint every ``Checkpoint.every`` rows.
+        """
+        every = self.checkpoint.every
+        n = 0
 
         for data in reader:
             row = reader.create_row(data)
@@ -53,326 +232,3416 @@ class CSVMod(object):
             if update:
                 writer.write(row.fields)
 
+            n += 1
+            if n == every:
+                n = 0
+                self.checkpoint.save(self.controller, reader, writer)
+
+    def run_incremental(self, reader, writer):
+        """
+        Like ``run()``, but skip rows found unchanged in the incremental state
+        and write their previous output instead. Statistics only cover the
+        rows that were handled.
+        """
+        state = IncrementalState(self.incremental, self.controller.primary_key,
+                                 controller_signature(self.controller))
+        state.begin(reader.header, reader.projection)
+
+        try:
+            for data in reader:
+                key, fingerprint, output = state.lookup(data)
+
+                if output is IncrementalState.MISSING:
+                    row = reader.create_row(data)
+
+                    update = self.controller.handle(row)
+                    self.controller.post_progress(row)
+
+                    if update is None:
+                        update = row.is_changed
+
+                    output = row.fields if update else None
+
+                if output is not None:
+                    writer.write(output)
+
+                state.store(key, fingerprint, output)
+        except BaseException:
+            state.abort()
+            raise
+
+        state.end()
+
+    def run_batches(self, reader, writer):
+        """
+        Feed the input to ``Controller.handle_batch`` in chunks of
+        ``Controller.batch_size`` rows and write back the changed rows.
+        """
+        size = self.controller.batch_size
+        iterator = iter(reader)
+
+        while True:
+            records = list(islice(iterator, size))
+            if not records:
+                break
+
+            batch = reader.create_batch(records)
+            update = self.controller.handle_batch(batch)
+
+            for row in batch.apply(update):
+                self.controller.post_progress(row)
+                writer.write(row.fields)
+
+
+class AsyncCSVMod(CSVMod):
+    """
+    Drives a controller with an ``async def handle(row)``. Up to
+    ``concurrency`` rows (default ``Controller.concurrency``) are handled at
+    the same time while the output keeps the input order.
+    """
+    def __init__(self, controller, concurrency=None, profiler=None):
+        super().__init__(controller, profiler=profiler)
+        self.concurrency = concurrency or controller.concurrency
+
+    def start(self, processes=1):
+        import asyncio
+
+        if processes > 1:
+            raise CSVError("Async controllers run in a single process")
+
+        try:
+            asyncio.run(self.run_async())
+        except BaseException:
+            self.controller.close()
+
+            if self.profiler is not None:
+                self.profiler.uninstall()
+            raise
+
         self.controller.finish()
 
+        if self.profiler is not None:
+            self.profiler.finish()
+
+    async def run_async(self, header=True):
+        import asyncio
+        from collections import deque
+
+        reader = self.controller.reader
+        reader.begin()
+
+        writer = self.controller.writer
+        writer.begin()
+
+        if self.profiler is not None:
+            self.profiler.install(self.controller, reader, writer)
+
+        if header:
+            writer.writeheader()
+
+        pending = deque()
+
+        try:
+            for data in reader:
+                row = reader.create_row(data)
+                pending.append((row, asyncio.ensure_future(self._handle(row))))
+
+                if len(pending) >= self.concurrency:
+                    await self._complete(*pending.popleft(), writer)
+
+            while pending:
+                await self._complete(*pending.popleft(), writer)
+        finally:
+            for row, task in pending:
+                task.cancel()
+
+    async def _handle(self, row):
+        import inspect
+
+        update = self.controller.handle(row)
+
+        if inspect.isawaitable(update):
+            update = await update
+
+        return update
+
+    async def _complete(self, row, task, writer):
+        update = await task
+        self.controller.post_progress(row)
+
+        if update is None:
+            update = row.is_changed
+
+        if update:
+            writer.write(row.fields)
+
+
+class MultiCSVMod(CSVMod):
+    """
+    Runs several controllers over a single pass of the first controller's
+    input. Each controller keeps its own fields, filter, joins, writer and
+    a copy of its statistics. Every record is parsed once, and converted once if any
+    controller accepts it. Each controller then gets its own row holding
+    the converted values of its fields, so changes made by one controller
+    are not seen by the others. Controllers that read the same field must
+    use the same converter for it.
+    """
+    def __init__(self, controllers):
+        import copy
+
+        super().__init__(controllers[0])
+        self.controllers = list(controllers)
+
+        # statistics are usually class attributes, shared by every controller that does not override them
+        for controller in self.controllers:
+            controller.statistics = copy.deepcopy(controller.statistics)
+
+    def start(self, processes=1):
+        if processes > 1:
+            raise CSVError("Multiple controllers run in a single process")
+
+        try:
+            self.run()
+        except BaseException:
+            for controller in self.controllers:
+                controller.close()
+            raise
+
+        for controller in self.controllers:
+            controller.finish()
+
+    def run(self, header=True):
+        for controller in self.controllers:
+            if getattr(controller, "handle_batch", None) is not None or is_coroutine_function(controller.handle):
+                raise CSVError("Multiple controllers require a synchronous handle()")
+
+        source = self.controller.reader
+        source_header = source.fieldnames
+        readers = [controller.reader for controller in self.controllers]
+
+        for reader in readers:
+            reader.prepare(source_header)
+
+        if isinstance(source.base_csv, (MappedReader, ColumnarReader)):
+            source.base_csv.columns = set().union(*(reader.projection for reader in readers))
+
+        names, converters = self.compile(readers)
+        width = len(source_header)
+        indices = [source_header.index(name) for name in names]
+        position = {name: i for i, name in enumerate(names)}
+        views = list()
+
+        for controller, reader in zip(self.controllers, readers):
+            writer = controller.writer
+            writer.begin()
+
+            if header:
+                writer.writeheader()
+
+            views.append((controller, reader, writer, reader._predicate,
+                          [position[name] for name in reader._layout.fields]))
+
+        for record in filter(None, source.base_csv):
+            values = None
+
+            for controller, reader, writer, predicate, fields in views:
+                if predicate is not None and not predicate(record):
+                    continue
+
+                if values is None:
+                    if len(record) < width:
+                        record = record + [None] * (width - len(record))
+
+                    values = [record[i] for i in indices]
+                    for pos, converter in converters:
+                        values[pos] = converter(values[pos])
+
+                row = reader.make_row([values[i] for i in fields])
+
+                update = controller.handle(row)
+                controller.post_progress(row)
+
+                if update is None:
+                    update = row.is_changed
+
+                if update:
+                    writer.write(row.fields)
+
+    @staticmethod
+    def compile(readers):
+        """
+        Return the union of the projected fields of all readers and the
+        (position, converter) pairs to apply to them.
+        """
+        names = list()
+        converters = dict()
+
+        keys = dict()
+
+        for reader in readers:
+            for name in reader._layout.fields:
+                key = reader.converter_key(name)
+
+                if name not in converters:
+                    names.append(name)
+                    converters[name] = reader.field_converter(name)
+                    keys[name] = key
+                elif keys[name] != key:
+                    raise CSVError("Controllers use different converters for field '%s'" % name)
+
+        return names, [(pos, converters[name]) for pos, name in enumerate(names) if converters[name] is not None]
+
+
+def _parallel_worker(job):
+    controller_class, input_file, output_file, start, end = job
+
+    controller = controller_class(input_file, output_file)
+    controller.reader.byte_range = (start, end)
+
+    # class level statistics and join counters hold the counts of the parent and of earlier jobs of this process
+    controller.statistics = [type(stat)() for stat in controller.statistics]
+    for join in walk_joins(controller.reader.joins):
+        join.stats = Statistics.Counter()
+
+    CSVMod(controller).run(header=False)
+
+    controller.close()
+
+    join_stats = [join.stats for join in walk_joins(controller.reader.joins)]
+
+    return controller.statistics, join_stats
+
+
+def walk_joins(joins: dict):
+    """
+    Yield the given joins and all of their nested joins, depth first.
+    """
+    for join in joins.values():
+        yield join
+        yield from walk_joins(join.joins)
+
 
 class CSVRow(object):
     """
+    Instead of a copy of the whole row, the original value of a field is saved
+    when it is written through ``row[field] = value`` for the first time.
+    Changes made directly to ``fields`` are not tracked.
+
     :type joins: dict
     """
-    def __init__(self, fields, joins, aliases: dict, file_name=None):
-        self.fields = fields
-        self.origin = dict(fields)
-        self.joins = joins
-        self.aliases = aliases
-        self.file_name = file_name
+    MISSING = object()
+
+    def __init__(self, fields, joins, aliases: dict, file_name=None):
+        self.fields = fields
+        self.joins = joins
+        self.aliases = aliases
+        self.file_name = file_name
+        self._saved = None
+
+    def __getitem__(self, item):
+        return self.fields[self._get_field_name(item, True)]
+
+    def __setitem__(self, key, value):
+        key = self._get_field_name(key, False)
+
+        if self._saved is None:
+            self._saved = dict()
+
+        if key not in self._saved:
+            self._saved[key] = self.fields.get(key, self.MISSING)
+
+        self.fields[key] = value
+
+    def __repr__(self):
+        return str(self.fields)
+
+    def _get_field_name(self, key, strict=True) -> str:
+        if key in self.fields:
+            return key
+
+        if key in self.aliases:
+            return self.aliases[key]
+
+        if strict:
+            raise CSVFieldError(key, file=self.file_name)
+        else:
+            return key
+
+    @property
+    def origin(self) -> dict:
+        origin = dict(self.fields)
+
+        for field, value in (self._saved or dict()).items():
+            if value is self.MISSING:
+                origin.pop(field, None)
+            else:
+                origin[field] = value
+
+        return origin
+
+    @property
+    def is_changed(self) -> bool:
+        if not self._saved:
+            return False
+
+        fields = self.fields
+        return any(value is self.MISSING or fields[field] != value for field, value in self._saved.items())
+
+    def changed_fields(self) -> list:
+        """
+        Return the fields of the original row that have a different value now.
+        """
+        if not self._saved:
+            return []
+
+        fields = self.fields
+        return [field for field, value in self._saved.items() if value is not self.MISSING and fields[field] != value]
+
+    def join(self, name, field=None):
+        """
+        :rtype: CSVRow
+        """
+        joint = self._join_source(name).auto_join(self)
+
+        if joint is None:
+            return None
+
+        if field is not None:
+            return joint[field]
+
+        return joint
+
+    async def join_async(self, name, field=None):
+        """
+        Awaitable variant of ``join`` for use in async handlers, which lets
+        lookups against async join sources overlap.
+
+        :rtype: CSVRow
+        """
+        joint = await self._join_source(name).auto_join_async(self)
+
+        if joint is None:
+            return None
+
+        if field is not None:
+            return joint[field]
+
+        return joint
+
+    def join_all(self, name) -> list:
+        """
+        Return every row of join ``name`` matching this row.
+
+        :rtype: list[CSVRow]
+        """
+        return self._join_source(name).auto_join_all(self)
+
+    def has_join(self, name) -> bool:
+        return name in self.joins.keys()
+
+    def _join_source(self, name):
+        try:
+            return self.joins[name]
+        except KeyError:
+            raise CSVError("Unknown join '%s'" % name)
+
+
+class RowLayout(object):
+    """
+    Per-file data shared by all ``CompactRow`` instances: the field -> index
+    map, joins, aliases and the file name.
+    """
+    __slots__ = ("fields", "index", "joins", "aliases", "file_name")
+
+    def __init__(self, fields, joins, aliases: dict, file_name=None):
+        self.fields = tuple(fields)
+        self.index = {field: i for i, field in enumerate(self.fields)}
+        self.joins = joins
+        self.aliases = aliases
+        self.file_name = file_name
+
+
+class CompactRow(object):
+    """
+    Memory efficient alternative to ``CSVRow`` with the same interface. The
+    values are stored in a list indexed through a shared ``RowLayout``.
+    Instead of a full copy of the row, the original value of a field is only
+    saved when it is written for the first time and a bitset marks the
+    written fields.
+    """
+    __slots__ = ("layout", "values", "_dirty", "_saved", "_extra")
+
+    def __init__(self, values: list, layout: RowLayout):
+        self.layout = layout
+        self.values = values
+        self._dirty = 0
+        self._saved = None
+        self._extra = None
+
+    def __getitem__(self, item):
+        index = self.layout.index.get(item)
+
+        if index is None:
+            index = self.layout.index.get(self.layout.aliases.get(item))
+
+        if index is not None:
+            return self.values[index]
+
+        if self._extra is not None and item in self._extra:
+            return self._extra[item]
+
+        raise CSVFieldError(item, file=self.layout.file_name)
+
+    def __setitem__(self, key, value):
+        layout = self.layout
+        index = layout.index.get(key)
+
+        if index is None and key in layout.aliases:
+            index = layout.index.get(layout.aliases[key])
+
+        if index is None:
+            if self._extra is None:
+                self._extra = dict()
+            self._extra[layout.aliases.get(key, key)] = value
+            return
+
+        bit = 1 << index
+        if not self._dirty & bit:
+            if self._saved is None:
+                self._saved = dict()
+            self._saved[index] = self.values[index]
+            self._dirty |= bit
+
+        self.values[index] = value
+
+    def __repr__(self):
+        return str(self.fields)
+
+    def _get_field_name(self, key, strict=True) -> str:
+        if key in self.layout.index or (self._extra is not None and key in self._extra):
+            return key
+
+        if key in self.layout.aliases:
+            return self.layout.aliases[key]
+
+        if strict:
+            raise CSVFieldError(key, file=self.layout.file_name)
+
+        return key
+
+    @property
+    def joins(self):
+        return self.layout.joins
+
+    @property
+    def aliases(self):
+        return self.layout.aliases
+
+    @property
+    def file_name(self):
+        return self.layout.file_name
+
+    @property
+    def fields(self) -> dict:
+        fields = dict(zip(self.layout.fields, self.values))
+
+        if self._extra is not None:
+            fields.update(self._extra)
+
+        return fields
+
+    @property
+    def origin(self) -> dict:
+        values = list(self.values)
+
+        if self._saved is not None:
+            for index, value in self._saved.items():
+                values[index] = value
+
+        return dict(zip(self.layout.fields, values))
+
+    @property
+    def is_changed(self) -> bool:
+        if self._extra:
+            return True
+
+        if self._saved is None:
+            return False
+
+        return any(self.values[i] != v for i, v in self._saved.items())
+
+    def changed_fields(self) -> list:
+        """
+        Return the fields of the original row that have a different value now.
+        """
+        if self._saved is None:
+            return []
+
+        fields, values = self.layout.fields, self.values
+        return [fields[i] for i, v in self._saved.items() if values[i] != v]
+
+    join = CSVRow.join
+    join_async = CSVRow.join_async
+    join_all = CSVRow.join_all
+    has_join = CSVRow.has_join
+    _join_source = CSVRow._join_source
+
+
+class CSVBatch(object):
+    """
+    Columnar view on a chunk of rows, handed to ``Controller.handle_batch``.
+
+    ``batch["Price"]`` returns the whole column, as a NumPy array if NumPy is
+    installed and the column is numeric, as a list otherwise. Assign a new
+    sequence of the same length to modify a column. Joins are still available
+    through ``batch.rows``, which are only created when accessed.
+    """
+    def __init__(self, rows: list, aliases: dict=None):
+        fields = list(rows[0].fields) if rows else []
+
+        self._rows = rows
+        self._make_row = None
+        self._init_columns(fields, [[row[field] for row in rows] for field in fields], len(rows), aliases)
+
+    @classmethod
+    def from_columns(cls, fields: list, columns: list, size: int, make_row, aliases: dict=None):
+        """
+        A batch of ``size`` rows given as one sequence per field. ``make_row``
+        turns the list of a row's values, in ``fields`` order, into a row.
+        """
+        batch = cls.__new__(cls)
+        batch._rows = None
+        batch._make_row = make_row
+        batch._init_columns(fields, columns, size, aliases)
+
+        return batch
+
+    def _init_columns(self, fields, columns, size, aliases):
+        self.size = size
+        self.aliases = aliases or dict()
+        self.columns = dict()
+        self.origin = dict()
+        self._values = columns
+
+        for field, values in zip(fields, columns):
+            column = self._column(values)
+            self.origin[field] = column
+            self.columns[field] = column.copy() if hasattr(column, "copy") else list(column)
+
+    @property
+    def rows(self) -> list:
+        if self._rows is None:
+            self._rows = list(map(self._make_row, map(list, zip(*self._values)))) if self._values else \
+                [self._make_row([]) for _ in range(self.size)]
+
+        return self._rows
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, item):
+        return self.columns[self._get_field_name(item, True)]
+
+    def __setitem__(self, key, values):
+        if len(values) != self.size:
+            raise CSVError("Column '%s' needs %d values, got %d" % (key, self.size, len(values)))
+
+        self.columns[self._get_field_name(key, False)] = values
+
+    def _get_field_name(self, key, strict=True) -> str:
+        if key in self.columns:
+            return key
+
+        if key in self.aliases:
+            return self.aliases[key]
+
+        if strict:
+            raise CSVFieldError(key)
+
+        return key
+
+    @staticmethod
+    def _column(values: list):
+        try:
+            import numpy
+        except ImportError:
+            return values
+
+        if values and all(type(v) in (int, float) for v in values):
+            return numpy.array(values)
+
+        return values
+
+    @staticmethod
+    def _to_list(values) -> list:
+        if hasattr(values, "tolist"):
+            return values.tolist()
+
+        return list(values)
+
+    def apply(self, update=None) -> list:
+        """
+        Copy modified column values back into the rows and return the rows to
+        write: all changed rows if ``update`` is None, all or none of the rows
+        if it is True or False, otherwise the rows whose entry in the
+        ``update`` sequence is true. Rows are only created for the rows to
+        write.
+        """
+        from operator import ne, or_
+
+        size = self.size
+
+        if update is not None and not isinstance(update, bool):
+            if not hasattr(update, "__len__") or len(update) != size:
+                raise CSVError("handle_batch must return None, a bool or a sequence of %d values, got %r"
+                               % (size, update))
+
+        diffs = list()
+
+        for field, column in self.columns.items():
+            origin = self.origin.get(field)
+            values = self._to_list(column)
+
+            if origin is None:
+                diff = [True] * size
+            elif hasattr(column, "dtype") and hasattr(origin, "dtype") and column.shape == origin.shape:
+                diff = (column != origin).tolist()
+            else:
+                diff = list(map(ne, origin, values))
+
+            if any(diff):
+                diffs.append((field, values, diff))
+
+        if isinstance(update, bool):
+            write = [update] * size
+        elif update is not None:
+            write = list(map(bool, update))
+        else:
+            write = [False] * size
+            for field, values, diff in diffs:
+                write = list(map(or_, write, diff))
+
+        if self._rows is not None:
+            # rows handed out through ``rows`` get every change, written or not
+            for field, values, diff in diffs:
+                for i in compress(range(size), diff):
+                    self._rows[i][field] = values[i]
+
+            return list(compress(self._rows, write))
+
+        result = list()
+        for i in compress(range(size), write):
+            row = self._make_row([column[i] for column in self._values])
+
+            for field, values, diff in diffs:
+                if diff[i]:
+                    row[field] = values[i]
+
+            result.append(row)
+
+        return result
+
+
+class LineReader(object):
+    """
+    Iterates over the decoded lines of a binary file handle while keeping
+    track of the byte offset behind the last line handed out. Feeding this to
+    ``csv.reader`` makes ``offset`` point to the end of the last parsed record,
+    since the csv module never reads ahead.
+    """
+    def __init__(self, handle, encoding="utf-8", end=None):
+        self.handle = handle
+        self.encoding = encoding
+        self.offset = handle.tell()
+        self.end = end
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        if self.end is not None and self.offset >= self.end:
+            raise StopIteration
+
+        line = self.handle.readline()
+        if not line:
+            raise StopIteration
+
+        self.offset += len(line)
+        return line.decode(self.encoding)
+
+
+class MappedReader(object):
+    """
+    Record iterator working directly on a memory mapped file between the byte
+    offsets ``start`` and ``end``. Records are split on the raw buffer and
+    only the column indices in ``columns`` are decoded (all if None), the
+    others are left as bytes. Records containing the quote character, or any
+    record for dialects with more options than delimiter and quotechar, are
+    handed to ``csv.reader``. ``offset`` is the byte offset behind the last
+    returned record. Requires an ASCII compatible encoding.
+    """
+    def __init__(self, buffer, start, end, encoding="utf-8", columns=None, **fmt):
+        self.buffer = buffer
+        self.offset = start
+        self.end = end
+        self.encoding = encoding
+        self.columns = columns
+        self.format = fmt
+
+        self.delimiter = fmt.get("delimiter", ",").encode(encoding)
+        self.quote = (fmt.get("quotechar") or "").encode(encoding)
+        self.simple = set(fmt) <= {"delimiter", "quotechar"}
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> list:
+        buffer, pos, end = self.buffer, self.offset, self.end
+
+        while pos < end:
+            newline = buffer.find(b"\n", pos, end)
+            stop = end if newline == -1 else newline
+            line = buffer[pos:stop]
+
+            while self.quote and line.count(self.quote) & 1 and stop < end:
+                newline = buffer.find(b"\n", stop + 1, end)
+                stop = end if newline == -1 else newline
+                line = buffer[pos:stop]
+
+            pos = self.offset = min(stop + 1, end)
+
+            if line.endswith(b"\r"):
+                line = line[:-1]
+
+            if not line:
+                continue
+
+            if not self.simple or (self.quote and self.quote in line):
+                return next(csv.reader([line.decode(self.encoding)], **self.format))
+
+            record = line.split(self.delimiter)
+
+            if self.columns is None:
+                return [value.decode(self.encoding) for value in record]
+
+            for i in self.columns:
+                if i < len(record):
+                    record[i] = record[i].decode(self.encoding)
+
+            return record
+
+        raise StopIteration
+
+
+class ColumnarReader(object):
+    """
+    Record iterator over a Parquet or Arrow IPC file, read batch by batch
+    with pyarrow. Only the column indices in ``columns`` are loaded (all if
+    None), the others are None in the returned records. Values keep the types
+    of the file.
+    """
+    def __init__(self, file_name, backend, columns=None, batch_size=65536):
+        try:
+            import pyarrow
+        except ImportError:
+            raise CSVError("%s input requires the 'pyarrow' package" % backend)
+
+        self.file_name = file_name
+        self.backend = backend
+        self.columns = columns
+        self.batch_size = batch_size
+        self._records = None
+
+        if backend == "parquet":
+            import pyarrow.parquet
+
+            self._file = pyarrow.parquet.ParquetFile(file_name)
+            self.header = list(self._file.schema_arrow.names)
+        elif backend == "arrow":
+            import pyarrow.ipc
+
+            self._file = pyarrow.ipc.open_file(pyarrow.memory_map(file_name))
+            self.header = list(self._file.schema.names)
+        else:
+            raise CSVError("Unknown input backend '%s'" % backend)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> list:
+        if self._records is None:
+            self._records = self._read()
+
+        return next(self._records)
+
+    def batches(self, names):
+        if self.backend == "parquet":
+            yield from self._file.iter_batches(self.batch_size, columns=names)
+            return
+
+        for i in range(self._file.num_record_batches):
+            yield self._file.get_batch(i).select(names)
+
+    def _read(self):
+        width = len(self.header)
+        indices = sorted(range(width) if self.columns is None else self.columns)
+        names = [self.header[i] for i in indices]
+        complete = indices == list(range(width))
+
+        for batch in self.batches(names):
+            columns = [column.to_pylist() for column in batch.columns]
+
+            if complete:
+                yield from map(list, zip(*columns))
+                continue
+
+            for values in zip(*columns):
+                record = [None] * width
+                for i, value in zip(indices, values):
+                    record[i] = value
+
+                yield record
+
+
+COMPRESSION_EXTENSIONS = {".gz": "gzip", ".bz2": "bz2", ".xz": "xz", ".lzma": "xz", ".zst": "zstd"}
+COMPRESSION_MAGIC = ((b"\x1f\x8b", "gzip"), (b"BZh", "bz2"), (b"\xfd7zXZ\x00", "xz"), (b"\x28\xb5\x2f\xfd", "zstd"))
+
+
+def detect_compression(file_name, mode="r"):
+    """
+    Guess the compression of a file from its extension, or from its magic
+    bytes when reading an existing file. Returns None for plain files.
+    """
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension in COMPRESSION_EXTENSIONS:
+        return COMPRESSION_EXTENSIONS[extension]
+
+    if "r" in mode and os.path.isfile(file_name):
+        with open(file_name, "rb") as handle:
+            head = handle.read(6)
+
+        for magic, compression in COMPRESSION_MAGIC:
+            if head.startswith(magic):
+                return compression
+
+    return None
+
+
+def open_compressed(file_name, mode, compression, level=None):
+    """
+    Open a binary stream through the given compression ("gzip", "bz2", "xz"
+    or "zstd"); ``mode`` is "rb" or "wb".
+    """
+    if compression == "gzip":
+        import gzip
+        return gzip.open(file_name, mode, compresslevel=9 if level is None else level)
+
+    if compression == "bz2":
+        import bz2
+        return bz2.open(file_name, mode, compresslevel=9 if level is None else level)
+
+    if compression == "xz":
+        import lzma
+        return lzma.open(file_name, mode, preset=level)
+
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise CSVError("zstd compression requires the 'zstandard' package")
+
+        if "r" in mode:
+            return zstandard.ZstdDecompressor().stream_reader(open(file_name, "rb"), closefd=True)
+
+        return zstandard.ZstdCompressor(level=3 if level is None else level).stream_writer(
+            open(file_name, "wb"), closefd=True)
+
+    raise CSVError("Unknown compression '%s'" % compression)
+
+
+def open_file(file_name, mode="r", encoding="utf-8", compression="auto", level=None, threaded=False, newline=None):
+    """
+    Open a text file for reading ("r") or writing ("w"), streaming through
+    a compression detected by ``detect_compression`` if ``compression`` is
+    "auto". With ``threaded`` the decompression runs in a background thread.
+    """
+    if compression == "auto":
+        compression = detect_compression(file_name, mode)
+
+    if compression is None:
+        return open(file_name, mode, encoding=encoding, newline=newline)
+
+    stream = open_compressed(file_name, mode + "b", compression, level)
+
+    if threaded and "r" in mode:
+        stream = io.BufferedReader(ThreadedReader(stream))
+
+    return io.TextIOWrapper(stream, encoding=encoding, newline=newline)
+
+
+class ThreadedReader(io.RawIOBase):
+    """
+    Reads a binary stream in a background thread, keeping up to ``depth``
+    chunks ahead of the consumer so that decompression overlaps with
+    processing.
+    """
+    def __init__(self, stream, chunk_size=1 << 20, depth=4):
+        import queue
+        import threading
+
+        super().__init__()
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.queue = queue.Queue(depth)
+        self.stopped = threading.Event()
+        self.pending = memoryview(b"")
+        self.eof = False
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        import queue
+
+        try:
+            while not self.stopped.is_set():
+                chunk = self.stream.read(self.chunk_size)
+
+                while not self.stopped.is_set():
+                    try:
+                        self.queue.put(chunk, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+
+                if not chunk:
+                    break
+        except Exception as e:
+            self.queue.put(e)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self.pending:
+            if self.eof:
+                return 0
+
+            chunk = self.queue.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+
+            if not chunk:
+                self.eof = True
+                return 0
+
+            self.pending = memoryview(chunk)
+
+        n = min(len(b), len(self.pending))
+        b[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.stopped.set()
+            self.thread.join()
+            self.stream.close()
+
+        super().close()
+
+
+class ColumnType(object):
+    """
+    Type of a ``schema`` column. ``convert`` parses a whole column at once,
+    falling back to ``convert_value`` per value if the fast path fails.
+    Empty values become None, values that are not strings (e.g. from
+    columnar files) are kept. ``formatter`` writes values back, None where
+    ``str()`` does.
+    """
+    name = None
+    arrow = None
+    formatter = None
+
+    def __init__(self, spec):
+        self.spec = spec
+
+    def convert(self, values: list) -> list:
+        try:
+            return self.convert_bulk(values)
+        except (ValueError, TypeError, KeyError, AttributeError):
+            return [self.convert_value(value) for value in values]
+
+    def convert_bulk(self, values: list) -> list:
+        return [self.convert_value(value) for value in values]
+
+    def convert_value(self, value):
+        if value is None or value == "":
+            return None
+
+        if not isinstance(value, str):
+            return value
+
+        try:
+            return self.parse(value)
+        except (ValueError, KeyError):
+            raise CSVError("Invalid %s value: %r" % (self.name, value))
+
+    def parse(self, value: str):
+        raise NotImplementedError
+
+
+class IntColumn(ColumnType):
+    name = "int"
+    arrow = "int64"
+    parse = staticmethod(int)
+
+    def convert_bulk(self, values):
+        # str.__str__ raises TypeError for values that are not strings, convert_value keeps those
+        return list(map(int, map(str.__str__, values)))
+
+
+class FloatColumn(ColumnType):
+    name = "float"
+    arrow = "float64"
+    parse = staticmethod(float)
+
+    def convert_bulk(self, values):
+        return list(map(float, map(str.__str__, values)))
+
+
+class CommaFloatColumn(ColumnType):
+    """
+    Floats with a decimal comma, like ``comma_decimal``.
+    """
+    name = "comma_float"
+    arrow = "float64"
+    parse = staticmethod(comma_decimal)
+
+    def convert_bulk(self, values):
+        return list(map(float, map(str.replace, values, repeat(","), repeat("."))))
+
+    @staticmethod
+    def formatter(value):
+        return "" if value is None else comma_decimal_formatter(value)
+
+
+class DateColumn(ColumnType):
+    """
+    ISO dates, or dates in the ``strptime`` format given as "date:FORMAT".
+    """
+    name = "date"
+    arrow = "date32"
+
+    def __init__(self, spec, date_format=None):
+        super().__init__(spec)
+        self.date_format = date_format
+
+        if date_format is not None:
+            self.formatter = self.format_value
+
+    def parse(self, value):
+        import datetime
+
+        if self.date_format is None:
+            return datetime.date.fromisoformat(value)
+
+        return datetime.datetime.strptime(value, self.date_format).date()
+
+    def convert_bulk(self, values):
+        import datetime
+
+        if self.date_format is None:
+            return list(map(datetime.date.fromisoformat, values))
+
+        return super().convert_bulk(values)
+
+    def format_value(self, value):
+        return "" if value is None else value.strftime(self.date_format)
+
+
+class BoolColumn(ColumnType):
+    """
+    1/0, true/false, yes/no, y/n, t/f, on/off in any case; written as 1/0.
+    """
+    name = "bool"
+    arrow = "bool"
+    values = {"1": True, "true": True, "yes": True, "y": True, "t": True, "on": True,
+              "0": False, "false": False, "no": False, "n": False, "f": False, "off": False, "": None}
+
+    def parse(self, value):
+        return self.values[value.lower()]
+
+    def convert_bulk(self, values):
+        return list(map(self.values.__getitem__, map(str.lower, values)))
+
+    @staticmethod
+    def formatter(value):
+        return "" if value is None else ("1" if value else "0")
+
+
+class CategoryColumn(ColumnType):
+    """
+    Strings from a small set of values, interned so that every row shares one
+    object per distinct value. If ``allowed`` values are given (the spec is a
+    list, tuple or set) others raise a ``CSVError``. Empty values become None.
+    """
+    name = "category"
+    arrow = "string"
+
+    def __init__(self, spec, allowed=None):
+        super().__init__(spec)
+        self.allowed = allowed
+        self.table = {value: value for value in allowed or ()}
+        self.table.update({"": None, None: None})
+
+    def convert_bulk(self, values):
+        if self.allowed is None:
+            return list(map(self.table.setdefault, values, values))
+
+        return list(map(self.table.__getitem__, values))
+
+    def convert_value(self, value):
+        if self.allowed is None:
+            return self.table.setdefault(value, value)
+
+        if value in self.table:
+            return self.table[value]
+
+        raise CSVError("Invalid category value: %r" % (value, ))
+
+
+class CallableColumn(ColumnType):
+    """
+    A custom conversion function, called once per value like a ``converter``.
+    """
+    name = "callable"
+
+    def convert(self, values):
+        return list(map(self.spec, values))
+
+    def convert_value(self, value):
+        return self.spec(value)
+
+
+COLUMN_TYPES = {
+    "int": IntColumn,
+    "float": FloatColumn,
+    "comma_float": CommaFloatColumn,
+    "date": DateColumn,
+    "bool": BoolColumn,
+    "category": CategoryColumn,
+}
+
+
+def column_type(spec) -> ColumnType:
+    """
+    Return the ``ColumnType`` for a schema entry: a name from
+    ``COLUMN_TYPES``, "date:FORMAT", a list, tuple or set of allowed category
+    values or a callable.
+    """
+    if isinstance(spec, ColumnType):
+        return spec
+
+    if callable(spec):
+        return CallableColumn(spec)
+
+    if isinstance(spec, (list, tuple, set, frozenset)):
+        return CategoryColumn(spec, spec)
+
+    name, _, argument = spec.partition(":")
+
+    if name == "date" and argument:
+        return DateColumn(spec, argument)
+
+    if name not in COLUMN_TYPES or argument:
+        raise CSVError("Unknown column type '%s'" % spec)
+
+    return COLUMN_TYPES[name](spec)
+
+
+class CSVFile(object):
+    def __init__(self, **kwargs):
+        self._fields = list()
+
+        self.file_name = kwargs.pop("file")
+        self.file_handle = None
+        self.format = dict(delimiter=";", quotechar='"')
+        self.encoding = kwargs.pop("encoding", "utf-8")
+        self.compression = kwargs.pop("compression", "auto")
+        self.compression_level = kwargs.pop("compression_level", None)
+        self.aliases = kwargs.pop("aliases", dict())
+        self.fields = kwargs.pop("fields", list())
+        self.converter = kwargs.pop("converter", dict())
+        self.schema = kwargs.pop("schema", dict())
+        self.base_csv = None
+        self.name = kwargs.pop("name", None)
+
+        if "format" in kwargs:
+            self.format.update(kwargs.pop("format"))
+
+        if len(kwargs) > 0:
+            raise KeyError("Invalid option: %s" % ", ".join(kwargs.keys()))
+
+    @property
+    def schema(self) -> dict:
+        """
+        Dict of field name -> column type, see ``column_type()``.
+        """
+        return self._schema
+
+    @schema.setter
+    def schema(self, schema):
+        both = set(schema) & set(self.converter)
+        if both:
+            raise CSVError("Fields with both a converter and a schema type: %s" % ", ".join(sorted(both)))
+
+        self._schema = schema
+        self.column_types = {field: column_type(spec) for field, spec in schema.items()}
+
+    def field_converter(self, name):
+        """
+        Return the function converting a single value of the field, from
+        ``schema`` or ``converter``, or None.
+        """
+        if name in self.column_types:
+            return self.column_types[name].convert_value
+
+        return self.converter.get(name)
+
+    def converter_key(self, name):
+        """
+        Comparable description of how a field is converted.
+        """
+        if name in self.column_types:
+            spec = self.schema[name]
+            return spec if callable(spec) else repr(spec)
+
+        converter = self.converter.get(name)
+        return converter if converter is None or callable(converter) else repr(converter)
+
+    @property
+    def fields(self):
+        return self._fields
+
+    @fields.setter
+    def fields(self, lst):
+        fields = list()
+        for field in lst:
+            if field in self.aliases:
+                fields.append(self.aliases[field])
+            else:
+                fields.append(field)
+
+        self._fields = fields
+
+    def begin(self):
+        pass
+
+    def detected_compression(self, mode="r"):
+        if self.compression == "auto":
+            return detect_compression(self.file_name, mode)
+
+        return self.compression
+
+    def _require_uncompressed(self, action):
+        if self.detected_compression():
+            raise CSVError("Compressed file '%s' can not be %s" % (self.file_name, action))
+
+    def end(self):
+        if self.file_handle is not None:
+            self.file_handle.close()
+            self.file_handle = None
+
+    def _reduce_fields(self, row: dict) -> dict:
+        return {k: v for k, v in row.items() if k in self.fields}
+
+
+class CSVReadFile(CSVFile):
+    def __init__(self, **kwargs):
+        self._joins = dict()
+        self.joins = kwargs.pop("joins", list())
+        self.backend = kwargs.pop("backend", "csv")
+        self.filter = kwargs.pop("filter", None)
+        self.compact = kwargs.pop("compact", False)
+        self.mmap = kwargs.pop("mmap", False)
+        self.threaded = kwargs.pop("threaded", True)
+        self.byte_range = None
+        self.header = None
+        self.projection = None
+        self._layout = None
+        self._pipeline = None
+        self._columns = None
+        self._predicate = None
+        self._buffer = None
+        self._lines = None
+
+        super().__init__(**kwargs)
+
+    @property
+    def joins(self):
+        return self._joins
+
+    @joins.setter
+    def joins(self, joins):
+        if isinstance(joins, CSVReadFile) or not hasattr(joins, "__iter__"):
+            joins = (joins, )
+
+        self._joins = dict()
+        for join in joins:
+            self._joins[join.name] = join
+
+    def __iter__(self):
+        return filter(self._predicate, self.base_csv)
+
+    @property
+    def offset(self):
+        """
+        Byte offset behind the last record read, or None if the file is read
+        in text mode (neither ``mmap`` nor a ``byte_range`` is set).
+        """
+        if self._lines is not None:
+            return self._lines.offset
+
+        return getattr(self.base_csv, "offset", None)
+
+    def check_header(self, header):
+        if self.fields is None:
+            return True
+
+        header = list(header)
+        fields = list(self.fields)
+
+        for field in fields:
+            if field not in header:
+                raise CSVHeaderError(field, header)
+
+        return True
+
+    def field_converter(self, name):
+        converter = super().field_converter(name)
+
+        # Parquet and Arrow values keep their types, converters only apply to text
+        if converter is not None and self.backend != "csv" and name not in self.column_types:
+            return _text_converter(converter)
+
+        return converter
+
+    def compile(self, header):
+        """
+        Prepare the row pipeline for the given header once: positions of the
+        projected columns, their names and the converters bound to them.
+        ``create_row`` then works on the plain lists produced by
+        ``csv.reader``.
+        """
+        projected = set(self.fields)
+        names = [name for name in header if name in projected]
+        indices = [header.index(name) for name in names]
+        converters = [(pos, self.field_converter(name)) for pos, name in enumerate(names)
+                      if self.field_converter(name) is not None]
+
+        self._layout = RowLayout(names, self.joins, self.aliases, self.name)
+        self._pipeline = (len(header), indices, names, converters)
+        self._columns = [(pos, self.column_types.get(name) or CallableColumn(self.field_converter(name)))
+                         for pos, name in enumerate(names) if self.field_converter(name) is not None]
+        self.projection = set(indices)
+        self._predicate = None
+
+        if self.filter:
+            self._predicate = self.compile_filter(header)
+            self.projection.update(header.index(self.aliases.get(field, field)) for field in self.filter)
+
+    def compile_filter(self, header):
+        """
+        Build a predicate on raw records from ``filter``, a dict mapping field
+        names to either a callable on the raw value or a dict of tests that
+        all have to pass:
+
+        * ``prefix``: the value starts with the string (or one of the tuple)
+        * ``eq``: the value equals
+        * ``in``: the value is one of
+        * ``min`` / ``max``: inclusive bounds of the value converted with the
+          field's converter (``float`` if it has none); rows failing the
+          conversion are rejected
+
+        Rows rejected by the filter are skipped before ``create_row``.
+        """
+        tests = list()
+
+        for field, spec in self.filter.items():
+            name = self.aliases.get(field, field)
+            if name not in header:
+                raise CSVHeaderError(name, header)
+
+            index = header.index(name)
+
+            if callable(spec):
+                tests.append((index, spec))
+                continue
+
+            for kind, value in spec.items():
+                tests.append((index, self._filter_test(kind, value, self.field_converter(name) or float)))
+
+        width = len(header)
+
+        def predicate(record):
+            if not record:
+                return False
+
+            if len(record) < width:
+                record = record + [None] * (width - len(record))
+
+            for i, test in tests:
+                if not test(record[i]):
+                    return False
+
+            return True
+
+        return predicate
+
+    @staticmethod
+    def _filter_test(kind, expected, converter):
+        if kind == "prefix":
+            prefix = tuple(expected) if isinstance(expected, (list, tuple, set)) else expected
+            return lambda value: value is not None and value.startswith(prefix)
+
+        if kind == "eq":
+            return lambda value: value == expected
+
+        if kind == "in":
+            values = frozenset(expected)
+            return lambda value: value in values
+
+        if kind in ("min", "max"):
+            def test(value):
+                try:
+                    value = converter(value)
+                except (ValueError, TypeError, AttributeError, CSVError):
+                    return False
+
+                if value is None:
+                    return False
+
+                return value >= expected if kind == "min" else value <= expected
+
+            return test
+
+        raise CSVError("Unknown filter test '%s'" % kind)
+
+    def create_row(self, data) -> CSVRow:
+        if not isinstance(data, dict):
+            return self._create_row_compiled(data)
+
+        for field, converter in self.converter.items():
+            data[field] = converter(data[field])
+
+        for field, column in self.column_types.items():
+            data[field] = column.convert_value(data[field])
+
+        if self.compact:
+            if self._layout is None:
+                self._layout = RowLayout([k for k in data if k in self.fields], self.joins, self.aliases, self.name)
+
+            return CompactRow([data[k] for k in self._layout.fields], self._layout)
+
+        return CSVRow(self._reduce_fields(data), self.joins, self.aliases, self.name)
+
+    def _create_row_compiled(self, record: list):
+        width, indices, names, converters = self._pipeline
+
+        if len(record) < width:
+            record = record + [None] * (width - len(record))
+
+        values = [record[i] for i in indices]
+        for pos, converter in converters:
+            values[pos] = converter(values[pos])
+
+        return self.make_row(values)
+
+    def create_rows(self, records: list) -> list:
+        """
+        ``create_row`` for a list of records. The converters and schema types
+        are applied a column at a time, which parses the built-in types in
+        bulk.
+        """
+        if self._pipeline is None or not records or isinstance(records[0], dict):
+            return [self.create_row(data) for data in records]
+
+        columns = self.create_columns(records)
+
+        if not columns:
+            return [self.make_row([]) for _ in records]
+
+        return list(map(self.make_row, map(list, zip(*columns))))
+
+    def create_columns(self, records: list) -> list:
+        """
+        Convert a list of records into one sequence of values per projected
+        field, in header order, without creating rows.
+        """
+        width, indices, names, converters = self._pipeline
+
+        if not indices or not records:
+            return [[] for _ in indices]
+
+        if min(map(len, records)) < width:
+            records = [record + [None] * (width - len(record)) for record in records]
+
+        if len(indices) == 1:
+            columns = [[record[indices[0]] for record in records]]
+        else:
+            columns = list(zip(*map(itemgetter(*indices), records)))
+
+        for pos, column in self._columns:
+            columns[pos] = column.convert(columns[pos])
+
+        return columns
+
+    def create_batch(self, records: list) -> CSVBatch:
+        """
+        A ``CSVBatch`` of the given records. The columns are converted in
+        bulk and rows are only created when they are needed.
+        """
+        if self._pipeline is None or not records or isinstance(records[0], dict):
+            return CSVBatch(self.create_rows(records), self.aliases)
+
+        return CSVBatch.from_columns(self._layout.fields, self.create_columns(records), len(records), self.make_row,
+                                     self.aliases)
+
+    def rows(self, batch_size=1024):
+        """
+        Yield a row for every record. With a ``schema`` the records are
+        converted ``batch_size`` at a time by ``create_rows``.
+        """
+        if not self.column_types:
+            for data in self:
+                yield self.create_row(data)
+            return
+
+        records = iter(self)
+        while True:
+            batch = list(islice(records, batch_size))
+            if not batch:
+                return
+
+            yield from self.create_rows(batch)
+
+    def make_row(self, values: list):
+        """
+        Wrap the already converted values of the projected fields, in header
+        order, in a row.
+        """
+        if self.compact:
+            return CompactRow(values, self._layout)
+
+        return CSVRow(dict(zip(self._layout.fields, values)), self.joins, self.aliases, self.name)
+
+    @property
+    def reader(self):
+        """
+        The underlying ``csv.reader``, positioned behind the header, which is
+        stored in ``header``.
+        """
+        if not self.base_csv:
+            self._open()
+
+        return self.base_csv
+
+    @property
+    def fieldnames(self) -> list:
+        if not self.base_csv:
+            self._open()
+
+        return self.header
+
+    def _require_uncompressed(self, action):
+        if self.backend != "csv":
+            raise CSVError("%s file '%s' can not be %s" % (self.backend, self.file_name, action))
+
+        super()._require_uncompressed(action)
+
+    def _open(self):
+        if self.mmap or self.byte_range is not None:
+            self._require_uncompressed("read with mmap or in byte ranges")
+
+        if self.backend != "csv":
+            self.base_csv = ColumnarReader(self.file_name, self.backend)
+            self.header = self.base_csv.header
+        elif self.mmap:
+            self._open_mapped()
+        elif self.byte_range is None:
+            self.file_handle = open_file(self.file_name, "r", self.encoding, self.compression,
+                                         threaded=self.threaded, newline="")
+            self.base_csv = csv.reader(self.file_handle, **self.format)
+            self.header = next(self.base_csv, [])
+        else:
+            start, end = self.byte_range
+            self.file_handle = open(self.file_name, "rb")
+            self.header = next(csv.reader(LineReader(self.file_handle, self.encoding), **self.format), [])
+
+            self.file_handle.seek(max(start, self.file_handle.tell()))
+            self._lines = LineReader(self.file_handle, self.encoding, end)
+            self.base_csv = csv.reader(self._lines, **self.format)
+
+    def _open_mapped(self):
+        import mmap
+
+        self.file_handle = open(self.file_name, "rb")
+        size = os.fstat(self.file_handle.fileno()).st_size
+        self._buffer = mmap.mmap(self.file_handle.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+        header = MappedReader(self._buffer, 0, size, self.encoding, **self.format)
+        self.header = next(header, [])
+
+        start, end = self.byte_range or (0, size)
+        end = size if end is None else end
+        self.base_csv = MappedReader(self._buffer, max(start, header.offset), end, self.encoding, **self.format)
+
+    def records_with_offsets(self):
+        """
+        Yield (byte offset, record) for every record of the file, reading it
+        independently of ``reader``.
+        """
+        self._require_uncompressed("indexed by byte offset")
+
+        if self.mmap:
+            reader = CSVReadFile(file=self.file_name, encoding=self.encoding, format=self.format, mmap=True)
+            records = reader.reader
+            offset = records.offset
+
+            for record in records:
+                yield offset, record
+                offset = records.offset
+
+            reader.end()
+            return
+
+        with open(self.file_name, "rb") as handle:
+            lines = LineReader(handle, self.encoding)
+            records = csv.reader(lines, **self.format)
+            next(records, None)
+            offset = lines.offset
+
+            for record in records:
+                if record:
+                    yield offset, record
+                offset = lines.offset
+
+    def byte_ranges(self, parts) -> list:
+        """
+        Split the records of the file into at most ``parts`` (start, end) byte
+        ranges that begin and end on record boundaries. Newlines inside quoted
+        fields are skipped, which requires an ASCII compatible encoding.
+        """
+        self._require_uncompressed("split into byte ranges")
+
+        quote = (self.format.get("quotechar") or "").encode(self.encoding)
+        block_size = 1 << 20
+
+        with open(self.file_name, "rb") as handle:
+            lines = LineReader(handle, self.encoding)
+            next(csv.reader(lines, **self.format), None)
+
+            size = os.fstat(handle.fileno()).st_size
+            bounds = [lines.offset]
+            pos = lines.offset
+            quoted = False
+            handle.seek(pos)
+
+            for i in range(1, parts):
+                target = bounds[0] + (size - bounds[0]) * i // parts
+
+                while pos < target:
+                    block = handle.read(min(block_size, target - pos))
+                    if quote:
+                        quoted ^= block.count(quote) & 1
+                    pos += len(block)
+
+                while pos < size:
+                    block = handle.read(block_size)
+                    found, quoted = self._find_record_end(block, quoted, quote)
+
+                    if found == -1:
+                        pos += len(block)
+                    else:
+                        pos += found
+                        handle.seek(pos)
+                        break
+
+                if pos > bounds[-1]:
+                    bounds.append(pos)
+
+            if size > bounds[-1]:
+                bounds.append(size)
+
+        return list(zip(bounds, bounds[1:]))
+
+    @staticmethod
+    def _find_record_end(block, quoted, quote):
+        i = 0
+        while True:
+            newline = block.find(b"\n", i)
+
+            if newline == -1:
+                if quote:
+                    quoted ^= block.count(quote, i) & 1
+                return -1, quoted
+
+            if quote:
+                quoted ^= block.count(quote, i, newline) & 1
+
+            if not quoted:
+                return newline + 1, quoted
+
+            i = newline + 1
+
+    def begin(self):
+        self.prepare(self.fieldnames)
+
+        if isinstance(self.base_csv, (MappedReader, ColumnarReader)):
+            self.base_csv.columns = self.projection
+
+    def prepare(self, header):
+        """
+        Check and compile the given header and begin the joins, without
+        reading anything from this file. ``begin()`` does this for the file's
+        own header, ``MultiCSVMod`` for records read by another reader.
+        """
+        if not self.fields:
+            self.fields = header
+        else:
+            self.check_header(header)
+
+        self.header = header
+        self.compile(header)
+
+        for join in self.joins.values():
+            join.begin()
+
+    def end(self):
+        if self._buffer:
+            self._buffer.close()
+            self._buffer = None
+
+        super().end()
+        for join in self.joins.values():
+            join.end()
+
+
+class CSVWriteFile(CSVFile):
+    """
+    Output file. By default every row is written immediately; with
+    ``buffer_size`` rows are collected and written ``buffer_size`` at a time,
+    by a background thread unless ``background`` is False. ``flush()`` and
+    ``end()`` wait until everything buffered is written.
+    """
+    def __init__(self, **kwargs):
+        self._plan = None
+        self._plan_keys = None
+        self.formatter = kwargs.pop("formatter", dict())
+        self.buffer_size = kwargs.pop("buffer_size", None)
+        self.background = kwargs.pop("background", True)
+
+        self._buffer = list()
+        self._queue = None
+        self._thread = None
+        self._error = None
+
+        if "name" not in kwargs:
+            kwargs["name"] = "target"
+
+        super().__init__(**kwargs)
+
+    @property
+    def writer(self) -> csv.DictWriter:
+        if not self.base_csv:
+            self.file_handle = open_file(self.file_name, "w", self.encoding, self.compression, self.compression_level)
+            self.base_csv = csv.DictWriter(self.file_handle, self.fields, **self.format)
+
+        return self.base_csv
+
+    @CSVFile.fields.setter
+    def fields(self, val):
+        self._fields = val
+        self._plan = None
+
+    @property
+    def aliases(self) -> dict:
+        return self._aliases
+
+    @aliases.setter
+    def aliases(self, val):
+        self._aliases = val
+        self._plan = None
+
+    @property
+    def formatter(self) -> dict:
+        return self._formatter
+
+    @formatter.setter
+    def formatter(self, val):
+        self._formatter = val
+        self._plan = None
+
+    def compile(self, keys):
+        """
+        Build the write plan for rows with the given keys: a list of
+        (source field, output field, formatter) triples equivalent to applying
+        the formatters and ``_reduce_fields``.
+        """
+        fields = set(self.fields)
+        plan = list()
+
+        for k in keys:
+            formatter = self.formatter.get(k)
+
+            if formatter is None and k in self.column_types:
+                formatter = self.column_types[k].formatter
+
+            if k in fields:
+                plan.append((k, k, formatter))
+
+            if k in self.aliases:
+                plan.append((k, self.aliases[k], formatter))
+
+        self._plan = plan
+        self._plan_keys = keys
+
+    def write(self, data):
+        keys = tuple(data)
+
+        if self._plan is None or keys != self._plan_keys:
+            self.compile(keys)
+
+        result = dict()
+        for source, target, formatter in self._plan:
+            value = data[source]
+            result[target] = value if formatter is None else formatter(value)
+
+        if self.buffer_size is None:
+            self.writer.writerow(result)
+            return
+
+        self._buffer.append(result)
+        if len(self._buffer) >= self.buffer_size:
+            self._submit()
+
+    def _submit(self):
+        batch, self._buffer = self._buffer, list()
+        self._check_error()
+
+        if not batch:
+            return
+
+        if not self.background:
+            self.writer.writerows(batch)
+            return
+
+        if self._thread is None:
+            import queue
+            import threading
+
+            self.writer  # open the file before handing it to the thread
+            self._queue = queue.Queue(4)
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+        self._queue.put(batch)
+
+    def _run(self):
+        while True:
+            batch = self._queue.get()
+
+            try:
+                if batch is None:
+                    return
+
+                if self._error is None:
+                    self.writer.writerows(batch)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _check_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def resume(self, offset):
+        """
+        Open the existing output file, discarding everything behind
+        ``offset``, and continue writing there without a header.
+        """
+        self._require_uncompressed("resumed")
+
+        self.file_handle = open(self.file_name, "r+", encoding=self.encoding)
+        self.file_handle.seek(offset)
+        self.file_handle.truncate()
+        self.base_csv = csv.DictWriter(self.file_handle, self.fields, **self.format)
+
+    def tell(self) -> int:
+        """
+        Flush and return the current byte offset in the output file.
+        """
+        self._require_uncompressed("checkpointed")
+        self.flush()
+
+        return self.file_handle.tell() if self.file_handle is not None else 0
+
+    def flush(self):
+        """
+        Write all buffered rows and flush the file handle.
+        """
+        self._submit()
+
+        if self._thread is not None:
+            self._queue.join()
+            self._check_error()
+
+        if self.file_handle is not None:
+            self.file_handle.flush()
+
+    def end(self):
+        try:
+            self.flush()
+        finally:
+            if self._thread is not None:
+                self._queue.put(None)
+                self._thread.join()
+                self._thread = None
+
+            super().end()
+
+    def writeheader(self):
+        self.writer.writeheader()
+
+    def append_file(self, file_name):
+        """
+        Copy the rows of another output file written with the same settings,
+        but without a header, to the end of this one.
+        """
+        self.flush()
+        self.writer
+
+        with open_file(file_name, "r", self.encoding, self.compression, newline="") as handle:
+            for chunk in iter(lambda: handle.read(1 << 20), ""):
+                self.file_handle.write(chunk)
+
+    def _reduce_fields(self, row: dict):
+        result = dict()
+
+        for k, v in row.items():
+            if k in self.fields:
+                result[k] = v
+
+            if k in self.aliases:
+                result[self.aliases[k]] = v
+
+        return result
+
+
+ARROW_TYPES = {
+    int: "int64",
+    float: "float64",
+    bool: "bool",
+    str: "string",
+    comma_decimal: "float64",
+    comma_decimal_formatter: "float64",
+}
+
+
+class ArrowWriteFile(CSVWriteFile):
+    """
+    Output file in a columnar format, written with pyarrow: ``backend`` is
+    "parquet" or "arrow" (the Arrow IPC file format). Rows are collected and
+    written ``buffer_size`` at a time as one row group / record batch.
+
+    Columns are typed: the type of a field is taken from ``types`` (pyarrow
+    types or names like "int64"), else derived from its ``converter`` or
+    ``formatter`` through ``ARROW_TYPES``, else inferred from the first batch.
+    Formatters with a known type are not applied, the typed value is written.
+    ``compression`` is the codec of the format, e.g. "zstd".
+    """
+    backends = ("parquet", "arrow")
+
+    def __init__(self, **kwargs):
+        self.backend = kwargs.pop("backend", "parquet")
+        self.types = kwargs.pop("types", dict())
+        self.arrow_schema = None
+        self._table_writer = None
+        self._targets = dict()
+
+        if self.backend not in self.backends:
+            raise CSVError("Unknown output backend '%s'" % self.backend)
+
+        kwargs.setdefault("buffer_size", 65536)
+        kwargs.setdefault("compression", None)
+        super().__init__(**kwargs)
+
+    @property
+    def writer(self):
+        if self._table_writer is None:
+            self._table_writer = _ArrowTableWriter(self)
+
+        return self._table_writer
+
+    def compile(self, keys):
+        super().compile(keys)
+
+        plan = list()
+        for source, target, formatter in self._plan:
+            column = self.column_types.get(source)
+            known = (column.arrow if column is not None else ARROW_TYPES.get(self.converter.get(source))) or \
+                ARROW_TYPES.get(formatter)
+            if known is not None:
+                self._targets[target] = known
+
+            plan.append((source, target, None if known else formatter))
+
+        self._plan = plan
+
+    def arrow_type(self, field, values):
+        """
+        Return the pyarrow type of an output field, inferred from ``values``
+        if it is neither configured nor derived.
+        """
+        import pyarrow
+
+        name = self.types.get(field) or self._targets.get(field)
+
+        if name is None:
+            inferred = pyarrow.array(values).type
+            return pyarrow.string() if pyarrow.types.is_null(inferred) else inferred
+
+        if isinstance(name, str):
+            return pyarrow.type_for_alias(name)
+
+        return name
+
+    def resume(self, offset):
+        raise CSVError("%s output can not be resumed" % self.backend)
+
+    def tell(self) -> int:
+        raise CSVError("%s output can not be checkpointed" % self.backend)
+
+    def append_file(self, file_name):
+        self.flush()
+        self.writer.append(file_name)
+
+    def begin(self):
+        super().begin()
+        self.writer
+
+    def end(self):
+        try:
+            super().end()
+        finally:
+            if self._table_writer is not None:
+                self._table_writer.close()
+                self._table_writer = None
+
+
+class _ArrowTableWriter(object):
+    """
+    ``writerows`` target of an ``ArrowWriteFile`` converting each batch of
+    row dicts to a record batch of the file's schema.
+    """
+    def __init__(self, output: ArrowWriteFile):
+        try:
+            import pyarrow
+        except ImportError:
+            raise CSVError("%s output requires the 'pyarrow' package" % output.backend)
+
+        self.output = output
+        self.writer = None
+
+    def writeheader(self):
+        pass
+
+    def writerow(self, row):
+        self.writerows([row])
+
+    def writerows(self, rows):
+        import pyarrow
+
+        output = self.output
+        columns = {field: [row.get(field) for row in rows] for field in output.fields}
+
+        if output.arrow_schema is None:
+            output.arrow_schema = pyarrow.schema([(field, output.arrow_type(field, columns[field]))
+                                            for field in output.fields])
+
+        try:
+            arrays = [pyarrow.array(columns[field.name], type=field.type) for field in output.arrow_schema]
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError) as e:
+            raise CSVError("Can not write %s output '%s': %s" % (output.backend, output.file_name, e))
+
+        self._open().write_batch(pyarrow.RecordBatch.from_arrays(arrays, schema=output.arrow_schema))
+
+    def append(self, file_name):
+        import pyarrow
+
+        if self.output.backend == "parquet":
+            import pyarrow.parquet
+            table = pyarrow.parquet.read_table(file_name)
+        else:
+            import pyarrow.ipc
+
+            with pyarrow.memory_map(file_name) as source:
+                table = pyarrow.ipc.open_file(source).read_all()
+
+        if self.output.arrow_schema is None:
+            self.output.arrow_schema = table.schema
+
+        for batch in table.to_batches():
+            self._open().write_batch(batch)
+
+    def _open(self):
+        if self.writer is not None:
+            return self.writer
+
+        import pyarrow
+
+        output = self.output
+        if output.arrow_schema is None:
+            output.arrow_schema = pyarrow.schema([(field, output.arrow_type(field, [])) for field in output.fields])
+
+        if output.backend == "parquet":
+            import pyarrow.parquet
+
+            self.writer = pyarrow.parquet.ParquetWriter(output.file_name, output.arrow_schema,
+                                                        compression=output.compression or "snappy")
+        else:
+            import pyarrow.ipc
+
+            options = pyarrow.ipc.IpcWriteOptions(compression=output.compression)
+            self.writer = pyarrow.ipc.new_file(output.file_name, output.arrow_schema, options=options)
+
+        return self.writer
+
+    def close(self):
+        self._open().close()
+
+
+class JoinCSV(CSVReadFile):
+    """
+    A secondary csv file whose rows are looked up by key for each row of the
+    main file.
+
+    The lookup strategy is chosen with the ``strategy`` option:
+
+    * ``scan`` (default) reads the join file forward until the key is found,
+      caching every parsed row if ``cache`` is enabled.
+    * ``hash`` builds a complete key -> row index in ``begin()``, so every
+      lookup is a single dict probe regardless of key order.
+    * ``merge`` expects both the main file and the join file to be sorted on
+      the join key and advances both in lockstep with constant memory. With
+      ``validate`` enabled (default) a ``CSVError`` is raised as soon as either
+      file is found out of order.
+    * ``disk`` keeps a sqlite index of key -> byte offset next to the join
+      file, named after the key columns (or at ``disk_index``), and parses a
+      single record per lookup. The index is reused across runs as long as
+      the join file's size and mtime and the key converters are unchanged.
+    * ``index`` (implied by the ``index`` option) binary searches a memory
+      mapped file of sorted keys and byte offsets, built beforehand with
+      ``csvmod.py index`` or in ``begin()`` if it is missing or out of date.
+      Only records whose key matches are parsed.
+
+    ``local`` and ``remote`` may be tuples of field names to join on several
+    columns. With ``multiple=True`` all rows sharing a key are kept and can be
+    fetched with ``get_rows()`` / ``CSVRow.join_all()``.
+
+    For the ``scan``, ``disk`` and ``index`` strategies ``cache_size`` bounds
+    the row cache, evicting the least recently used keys. ``disk`` and
+    ``index`` joins keep ``disk_cache_size`` keys unless ``cache_size`` is
+    given; ``cache_size=None`` caches every key looked up. Once a ``scan`` join has
+    evicted a row, a lookup missing the cache and the rest of the file reads
+    the file again from the start. Hits, misses, evictions and
+    scanned rows are counted in ``stats`` and reported by ``Statistics``.
+
+    Parquet and Arrow join files are read with ``backend="parquet"`` or
+    ``"arrow"``, loading only ``fields`` and the key columns. The ``disk``
+    strategy needs a delimited text file.
+
+    With ``shared`` enabled (default) ``hash`` joins that read the same
+    unchanged file with the same options, including identical nested joins,
+    build their index once per process and share it through
+    ``join_registry``. The shared rows are the same objects, handlers must
+    not modify joined rows.
+    """
+    strategies = ("scan", "hash", "merge", "disk", "index")
+    disk_cache_size = 10000
+    index_magic = b"CSVMIDX1"
+    index_entry = "<QIQ"
+
+    def __init__(self, **kwargs):
+        self.local_field = kwargs.pop("local")
+        self.join_field = kwargs.pop("remote")
+
+        self.strategy = kwargs.pop("strategy", "scan")
+        self.multiple = kwargs.pop("multiple", False)
+        self.validate = kwargs.pop("validate", True)
+        self.disk_index = kwargs.pop("disk_index", None)
+        self.index = kwargs.pop("index", None)
+        self.shared = kwargs.pop("shared", True)
+
+        if self.index is not None:
+            self.strategy = "index"
+
+        self.cache_enabled = kwargs.pop("cache", True)
+        self.cache_size = kwargs.pop("cache_size", self.disk_cache_size if self.strategy in ("disk", "index") else None)
+        self.cache = OrderedDict() if self.cache_size is not None else dict()
+        self._evicted = False
+        self.stats = Statistics.Counter()
+
+        self._disk_db = None
+        self._disk_handle = None
+        self._index_map = None
+        self._index_table = None
+        self._key_spec = None
+
+        self._merge_iter = None
+        self._merge_head = None
+        self._merge_head_key = None
+        self._merge_last = None
+        self._merge_group = []
+
+        if self.strategy not in self.strategies:
+            raise KeyError("Invalid join strategy: %s" % self.strategy)
+
+        if isinstance(self.local_field, (tuple, list)) != isinstance(self.join_field, (tuple, list)):
+            raise CSVError("Join keys 'local' and 'remote' must have the same arity")
+
+        if "name" not in kwargs:
+            kwargs["name"] = kwargs["file"]
+
+        super().__init__(**kwargs)
+
+        if self.disk_index is None:
+            key = "-".join("".join(c if c.isalnum() else "_" for c in field) for field in self._key_fields())
+            self.disk_index = "%s.%s.idx.sqlite" % (self.file_name, key)
+
+        if self.index is None:
+            self.index = self.file_name + ".index"
+
+    def begin(self):
+        key = self.registry_key()
+
+        if key is not None:
+            shared = join_registry.get(key)
+
+            if shared is not None:
+                self.cache = shared.cache
+                return
+
+        super().begin()
+
+        if self.strategy == "hash":
+            self.build_index()
+
+            if key is not None:
+                join_registry.store(key, self)
+        elif self.strategy == "merge":
+            self._merge_iter = iter(self)
+            self._merge_next()
+        elif self.strategy == "disk":
+            self.build_disk_index()
+        elif self.strategy == "index":
+            self.load_index_file()
+
+    def end(self):
+        super().end()
+
+        if self._disk_db is not None:
+            self._disk_db.close()
+            self._disk_db = None
+
+        if self._index_map is not None:
+            self._index_map.close()
+            self._index_map = self._index_table = None
+
+        if self._disk_handle is not None:
+            self._disk_handle.close()
+            self._disk_handle = None
+
+    def registry_key(self):
+        """
+        Key of the index of this join in ``join_registry``: everything that
+        affects the indexed rows. None if the join can not be shared.
+        """
+        if not self.shared or self.strategy != "hash":
+            return None
+
+        nested = list()
+        for join in self.joins.values():
+            nested_key = join.registry_key() if isinstance(join, JoinCSV) else None
+
+            if nested_key is None:
+                return None
+
+            nested.append((join.name, nested_key))
+
+        try:
+            stat = os.stat(self.file_name)
+        except OSError:
+            return None
+
+        return (os.path.abspath(self.file_name), stat.st_size, stat.st_mtime_ns, self.backend, self.encoding,
+                self.compression, tuple(sorted(self.format.items())), self.name, self._key_fields(), tuple(self.fields),
+                tuple(sorted(self.converter.items())), repr(sorted(self.schema.items())),
+                tuple(sorted(self.aliases.items())), repr(self.filter),
+                self.multiple, self.compact, tuple(nested))
+
+    def build_index(self):
+        """
+        Read the whole join file into ``self.cache``, keyed by the remote
+        field(s).
+        """
+        self.cache = dict()
+        records = iter(self)
+
+        while True:
+            batch = list(islice(records, 1024))
+            if not batch:
+                break
+
+            self.stats.plus("scanned", len(batch))
+
+            for data, row in zip(batch, self.create_rows(batch)):
+                key = self._record_key(data)
+
+                if self.multiple:
+                    self.cache.setdefault(key, []).append(row)
+                elif key not in self.cache:
+                    self.cache[key] = row
+
+    def build_disk_index(self):
+        """
+        Open the sqlite offset index for the join file, (re)building it if it
+        is missing or was built for a different version of the file.
+        """
+        import sqlite3
+
+        self._require_uncompressed("joined with the disk strategy")
+
+        if self._key_spec is None:
+            self.compile(self.fieldnames)
+
+        stat = os.stat(self.file_name)
+        signature = repr((stat.st_size, stat.st_mtime_ns, self.join_field,
+                          sorted(self.format.items()), self.encoding, self._key_converters()))
+
+        self._disk_handle = open(self.file_name, "rb")
+        self._disk_db = db = sqlite3.connect(self.disk_index)
+        db.execute("CREATE TABLE IF NOT EXISTS meta (signature TEXT)")
+        db.execute("CREATE TABLE IF NOT EXISTS idx (key, offset INTEGER)")
+
+        current = db.execute("SELECT signature FROM meta").fetchone()
+        if current is not None and current[0] == signature:
+            return
+
+        db.execute("DROP INDEX IF EXISTS idx_key")
+        db.execute("DELETE FROM idx")
+        db.execute("DELETE FROM meta")
+
+        batch = []
+        for offset, record in self.records_with_offsets():
+            batch.append((self._index_key(self._record_key(record)), offset))
+
+            if len(batch) >= 10000:
+                db.executemany("INSERT INTO idx VALUES (?, ?)", batch)
+                batch = []
+
+        db.executemany("INSERT INTO idx VALUES (?, ?)", batch)
+        db.execute("CREATE INDEX idx_key ON idx (key)")
+        db.execute("INSERT INTO meta VALUES (?)", (signature, ))
+        db.commit()
+
+    def index_signature(self) -> list:
+        """
+        Identifies the join file version and the options the offset index
+        file depends on.
+        """
+        stat = os.stat(self.file_name)
+
+        return [stat.st_size, stat.st_mtime_ns, list(self._key_fields()), sorted(self.format.items()), self.encoding,
+                self._key_converters()]
+
+    def _key_converters(self) -> list:
+        converters = list()
+        for field in self._key_fields():
+            key = self.converter_key(field)
+            converters.append(key if key is None or isinstance(key, str) else "%s.%s" % (key.__module__, key.__qualname__))
+
+        return converters
+
+    def build_index_file(self, force=False) -> bool:
+        """
+        Write the offset index file for the ``index`` strategy unless an up
+        to date one exists or ``force`` is set. Returns whether it was built.
+
+        The file holds a JSON header, a table of (key position, key length,
+        record offset) entries sorted by key and the ``repr()`` of the keys.
+        """
+        import json
+        import struct
+
+        if not force and self._index_header() is not None:
+            return False
+
+        if self._key_spec is None:
+            self.compile(self.fieldnames)
+
+        entries = sorted((repr(self._record_key(record)).encode("utf-8"), offset)
+                         for offset, record in self.records_with_offsets())
+
+        header = json.dumps(dict(signature=self.index_signature(), count=len(entries))).encode("utf-8")
+        temp = "%s.%d.tmp" % (self.index, os.getpid())
+
+        with open(temp, "wb") as f:
+            f.write(self.index_magic + struct.pack("<I", len(header)) + header)
+
+            position = 0
+            for key, offset in entries:
+                f.write(struct.pack(self.index_entry, position, len(key), offset))
+                position += len(key)
+
+            for key, offset in entries:
+                f.write(key)
+
+        os.replace(temp, self.index)
+        return True
+
+    def build_offset_index(self):
+        """
+        Build the offset index of the ``disk`` or ``index`` strategy if it is
+        missing or out of date, then close the join again.
+        """
+        try:
+            if self.strategy == "disk":
+                self.build_disk_index()
+            elif self.strategy == "index":
+                self.build_index_file()
+        finally:
+            self.end()
+            self.base_csv = None
+
+    def _index_header(self):
+        import json
+        import struct
+
+        try:
+            with open(self.index, "rb") as f:
+                if f.read(len(self.index_magic)) != self.index_magic:
+                    return None
+
+                length, = struct.unpack("<I", f.read(4))
+                header = json.loads(f.read(length))
+        except (OSError, ValueError, struct.error):
+            return None
+
+        if header.get("signature") != json.loads(json.dumps(self.index_signature())):
+            return None
+
+        header["start"] = len(self.index_magic) + 4 + length
+        return header
+
+    def load_index_file(self):
+        """
+        Memory map the offset index file, building it first if it is missing
+        or out of date.
+        """
+        import mmap
+        import struct
+
+        self._require_uncompressed("joined with the index strategy")
+
+        header = self._index_header()
+        if header is None:
+            self.build_index_file(force=True)
+            header = self._index_header()
+
+        self._disk_handle = open(self.file_name, "rb")
+
+        with open(self.index, "rb") as f:
+            self._index_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        table = header["start"]
+        size = struct.calcsize(self.index_entry)
+        self._index_table = (table, header["count"], size, table + header["count"] * size)
+
+    def _index_offsets(self, criteria, first=False) -> list:
+        import struct
+
+        buffer = self._index_map
+        table, count, size, keys = self._index_table
+        entry = struct.Struct(self.index_entry)
+        needle = repr(criteria).encode("utf-8")
+
+        def key_at(i):
+            position, length, offset = entry.unpack_from(buffer, table + i * size)
+            return buffer[keys + position:keys + position + length], offset
+
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if key_at(mid)[0] < needle:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        offsets = []
+        while lo < count:
+            key, offset = key_at(lo)
+            if key != needle:
+                break
+
+            offsets.append(offset)
+            if first:
+                break
+
+            lo += 1
+
+        return offsets
+
+    def get_row(self, criteria) -> CSVRow:
+        if self.strategy == "hash":
+            f = self.get_row_indexed
+        elif self.strategy == "merge":
+            f = self.get_row_merged
+        elif self.strategy in ("disk", "index"):
+            f = self.get_row_disk
+        elif self.cache_enabled:
+            f = self.get_row_cached
+        else:
+            f = self.get_row_uncached
+
+        data = f(criteria)
+
+        return data
+
+    def get_rows(self, criteria) -> list:
+        """
+        Return all rows matching ``criteria``. Requires ``strategy="hash"``
+        with ``multiple=True``, otherwise at most one row is returned.
+        """
+        if self.strategy == "hash" and self.multiple:
+            return list(self.cache.get(criteria, ()))
+
+        if self.strategy == "merge":
+            return list(self.get_rows_merged(criteria))
+
+        if self.strategy in ("disk", "index"):
+            return self.get_rows_disk(criteria)
+
+        row = self.get_row(criteria)
+        return [] if row is None else [row]
+
+    def get_row_indexed(self, criteria) -> CSVRow:
+        row = self.cache.get(criteria)
+
+        if row is None:
+            self.stats.plus("misses")
+            return None
+
+        self.stats.plus("hits")
+
+        if self.multiple:
+            return row[0]
+
+        return row
+
+    def get_row_merged(self, criteria) -> CSVRow:
+        rows = self.get_rows_merged(criteria)
+        return rows[0] if rows else None
+
+    def get_rows_merged(self, criteria) -> list:
+        if self._merge_last is not None:
+            if criteria == self._merge_last:
+                return self._merge_group
+
+            if criteria < self._merge_last:
+                if self.validate:
+                    raise CSVError("Main file is not sorted on '%s' (%r after %r)"
+                                   % (self.local_field, criteria, self._merge_last))
+                return []
+
+        while self._merge_head is not None and self._merge_head_key < criteria:
+            self._merge_next()
+
+        group = []
+        while self._merge_head is not None and self._merge_head_key == criteria:
+            group.append(self._merge_head)
+            self._merge_next()
+
+            if not self.multiple:
+                break
+
+        self.stats.plus("hits" if group else "misses")
+        self._merge_last = criteria
+        self._merge_group = group
+
+        return group
+
+    def _merge_next(self):
+        try:
+            data = next(self._merge_iter)
+        except StopIteration:
+            self._merge_head = None
+            return
+
+        self.stats.plus("scanned")
+        row = self.create_row(data)
+        key = self._record_key(data)
+
+        if self.validate and self._merge_head is not None and key < self._merge_head_key:
+            raise CSVError("Join file '%s' is not sorted on '%s' (%r after %r)"
+                           % (self.file_name, self.join_field, key, self._merge_head_key))
+
+        self._merge_head = row
+        self._merge_head_key = key
+
+    def get_row_disk(self, criteria) -> CSVRow:
+        rows = self.get_rows_disk(criteria)
+        return rows[0] if rows else None
+
+    def get_rows_disk(self, criteria) -> list:
+        if self.cache_enabled:
+            try:
+                rows = self._cache_lookup(criteria)
+                self.stats.plus("hits")
+                return rows
+            except KeyError:
+                pass
+
+        self.stats.plus("misses")
+
+        # rows rejected by the filter are only skipped here, the indexes hold every record
+        first = not self.multiple and self._predicate is None
+
+        if self.strategy == "index":
+            offsets = self._index_offsets(criteria, first)
+        else:
+            cursor = self._disk_db.execute("SELECT offset FROM idx WHERE key = ? ORDER BY rowid LIMIT ?",
+                                           (self._index_key(criteria), 1 if first else -1))
+            offsets = [offset for (offset, ) in cursor.fetchall()]
+
+        rows = []
+        for offset in offsets:
+            record = self._read_at(offset)
+
+            if self._predicate is None or self._predicate(record):
+                rows.append(self.create_row(record))
+
+                if not self.multiple:
+                    break
+
+        if self.cache_enabled:
+            self._cache_store(criteria, rows)
+
+        return rows
+
+    def _read_at(self, offset) -> list:
+        self.stats.plus("scanned")
+        self._disk_handle.seek(offset)
+
+        return next(csv.reader(LineReader(self._disk_handle, self.encoding), **self.format))
+
+    def get_row_uncached(self, criteria) -> dict:
+        for row in self:
+            self.stats.plus("scanned")
+            if self._record_key(row) == criteria:
+                return self.create_row(row)
+
+    def get_row_cached(self, criteria) -> dict:
+        try:
+            row = self._cache_lookup(criteria)
+            self.stats.plus("hits")
+            return row
+        except KeyError:
+            self.stats.plus("misses")
+
+        for rescan in (False, True):
+            if rescan:
+                # rows behind the reader may have been evicted, read the file again from the start
+                if not self._evicted:
+                    return None
+
+                self.rewind()
+
+            for row in self:
+                self.stats.plus("scanned")
+                r = self.create_row(row)
+                key = self._record_key(row)
+                self._cache_store(key, r)
+
+                if key == criteria:
+                    return r
+
+    def rewind(self):
+        """
+        Start reading the join file from its first record again.
+        """
+        if self._buffer:
+            self._buffer.close()
+            self._buffer = None
+
+        CSVFile.end(self)
+        self.base_csv = None
+        self._open()
+
+        if isinstance(self.base_csv, (MappedReader, ColumnarReader)):
+            self.base_csv.columns = self.projection
+
+    def _cache_lookup(self, key):
+        value = self.cache[key]
+
+        if self.cache_size is not None:
+            self.cache.move_to_end(key)
+
+        return value
+
+    def _cache_store(self, key, value):
+        self.cache[key] = value
+
+        if self.cache_size is not None:
+            self.cache.move_to_end(key)
+
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+                self.stats.plus("evictions")
+                self._evicted = True
+
+    def auto_join(self, row: CSVRow) -> CSVRow:
+        return self.get_row(self.criteria(row))
+
+    async def get_row_async(self, criteria) -> CSVRow:
+        """
+        Awaitable lookup used by ``CSVRow.join_async``. The default performs
+        the regular lookup; join sources backed by async services override
+        this.
+        """
+        return self.get_row(criteria)
+
+    async def auto_join_async(self, row: CSVRow) -> CSVRow:
+        return await self.get_row_async(self.criteria(row))
+
+    def auto_join_all(self, row: CSVRow) -> list:
+        return self.get_rows(self.criteria(row))
+
+    def criteria(self, row: CSVRow):
+        return self._key(row, self.local_field)
+
+    def compile(self, header):
+        super().compile(header)
+
+        self._key_spec = list()
+        for field in self._key_fields():
+            if field not in header:
+                raise CSVHeaderError(field, header)
+
+            self._key_spec.append((header.index(field), self.field_converter(field)))
+            self.projection.add(header.index(field))
+
+    def _record_key(self, record: list):
+        key = tuple(record[i] if converter is None else converter(record[i]) for i, converter in self._key_spec)
+
+        if isinstance(self.join_field, (tuple, list)):
+            return key
+
+        return key[0]
+
+    def _key_fields(self) -> tuple:
+        if isinstance(self.join_field, (tuple, list)):
+            return tuple(self.join_field)
+
+        return self.join_field,
+
+    @staticmethod
+    def _index_key(key):
+        if isinstance(key, (str, int, float)):
+            return key
+
+        return repr(key)
+
+    @staticmethod
+    def _key(row, field):
+        if isinstance(field, (tuple, list)):
+            return tuple(row[f] for f in field)
+
+        return row[field]
+
+
+class JoinRegistry(object):
+    """
+    Process-wide map of ``JoinCSV.registry_key()`` to the join that built
+    the index. Joins are held weakly, an index lives as long as a join using
+    it does.
+    """
+    def __init__(self):
+        import weakref
+
+        self.joins = weakref.WeakValueDictionary()
+
+    def get(self, key):
+        """
+        :rtype: JoinCSV
+        """
+        return self.joins.get(key)
+
+    def store(self, key, join):
+        self.joins[key] = join
+
+    def clear(self):
+        self.joins.clear()
+
+
+join_registry = JoinRegistry()
+
+
+class Statistics(object):
+    class Counter(object):
+        def __init__(self, allow_negative=True):
+            self.slots = dict()
+            self.allow_negative = allow_negative
+
+        def plus(self, slot, n=1):
+            try:
+                self.slots[slot] += n
+            except KeyError:
+                self.slots[slot] = n
+
+            if not self.allow_negative and self[slot] < 0:
+                self.slots[slot] = 0
+
+        def minus(self, slot, n=1):
+            self.plus(slot, -n)
+
+        def __getitem__(self, item):
+            return self.slots.get(item, 0)
+
+        def merge(self, other):
+            for slot, n in other.slots.items():
+                self.plus(slot, n)
+
+    def __init__(self):
+        self.changes = {}
+        self.rows = 0
+
+    def merge(self, other):
+        """
+        Add the counts of another ``Statistics`` instance, e.g. from a worker
+        process.
+        """
+        for field, n in other.changes.items():
+            self._incr("changes", field, n)
+
+        self.rows += other.rows
+
+    def process(self, data):
+        changed = data.changed_fields()
+
+        for field in changed:
+            self._incr("changes", field)
+
+        if changed:
+            self.rows += 1
+
+    def finish(self):
+        import operator
+        print("Finished, modified %d rows." % self.rows)
+        s = sorted(self.changes.items(), key=operator.itemgetter(1))
+
+        for field, changes in s:
+            print("%6d %s" % (changes, field))
+
+    def finish_joins(self, joins):
+        """
+        Print the lookup counters of the given joins and their nested joins.
+        """
+        for join in joins.values():
+            stats = getattr(join, "stats", None)
+
+            if stats is not None:
+                print("Join '%s': %d hits, %d misses, %d evictions, %d rows scanned" % (
+                    join.name, stats["hits"], stats["misses"], stats["evictions"], stats["scanned"]))
+
+            self.finish_joins(join.joins)
+
+    def _incr(self, prop, index, n=1):
+        try:
+            self.__dict__[prop][index] += n
+        except KeyError:
+            self.__dict__[prop][index] = n
+
+
+class Profiler(object):
+    """
+    Records the time spent and the number of calls per stage of the row loop
+    (parse, create_row, handle, statistics, write) and per join. Join times
+    are part of the handle time, nested joins part of their parent's.
+
+    :param sample: only time every ``sample``-th row, or batch of rows, and
+        scale the results. The stages of the other rows run without any
+        wrapper, which keeps the overhead low; their calls are estimated.
+    :param progress: print a progress line to ``stream`` (default stderr)
+        every ``progress`` seconds.
+    :param summary: path to write the JSON summary to in ``finish()``.
+    """
+    MISSING = object()
 
-    def __getitem__(self, item):
-        return self.fields[self._get_field_name(item, True)]
+    def __init__(self, sample=1, progress=None, summary=None, stream=None):
+        self.sample = sample
+        self.progress = progress
+        self.summary = summary
+        self.stream = stream
 
-    def __setitem__(self, key, value):
-        getattr(self, "fields")[self._get_field_name(key, False)] = value
+        self.times = dict()
+        self.calls = dict()
 
-    def __repr__(self):
-        return str(self.fields)
+        self.rows = 0
+        self.created = 0
+        self.sampled = 0
+        self.armed = False
+        self.started = None
+        self.reader = None
+        self.size = None
+        self._units = 0
+        self._creating = False
+        self._hooks = list()
+        self._stages = list()
+        self._next_progress = None
+
+    def install(self, controller, reader, writer):
+        """
+        Wrap the stages of the given controller, its reader, writer and joins
+        until ``uninstall()``. The row creation methods start a new row or
+        batch; only sampled ones run through the timing wrappers.
+        """
+        self.started = time.perf_counter()
+        self.reader = reader
+        self._next_progress = self.started + (self.progress or 0)
 
-    def _get_field_name(self, key, strict=True) -> str:
-        if key in self.fields:
-            return key
+        if not reader.detected_compression():
+            self.size = os.path.getsize(reader.file_name)
 
-        if key in self.aliases:
-            return self.aliases[key]
+        reader.base_csv = ProfiledIterator(reader.base_csv, self)
+        self.times.setdefault("parse", 0.0)
+        self.calls.setdefault("parse", 0)
 
-        if strict:
-            raise CSVFieldError(key, file=self.file_name)
-        else:
-            return key
+        self._hook(self._hooks, reader, "create_row", self._unit(reader.create_row, lambda data: 1))
+        self._hook(self._hooks, reader, "create_rows", self._unit(reader.create_rows, len))
+        self._hook(self._hooks, reader, "create_batch", self._unit(reader.create_batch, len))
 
-    @property
-    def is_changed(self) -> bool:
-        return self.origin != self.fields
+        stages = [(controller, "handle", "handle"), (controller, "post_progress", "statistics"),
+                  (writer, "write", "write")]
 
-    def join(self, name, field=None):
+        if getattr(controller, "handle_batch", None) is not None:
+            stages.append((controller, "handle_batch", "handle"))
+
+        stages.extend((join, "auto_join", "join:%s" % join.name) for join in walk_joins(reader.joins))
+
+        for obj, name, stage in stages:
+            self._stages.append((obj, name, self.wrap(stage, getattr(obj, name)), vars(obj).get(name, self.MISSING)))
+
+    def uninstall(self):
         """
-        :rtype: CSVRow
+        Put back every method replaced by ``install()``.
         """
-        try:
-            join = self.joins[name]
-        except KeyError:
-            raise CSVError("Unknown join '%s'" % name)
+        self._arm(False)
 
-        joint = join.auto_join(self)
+        for obj, name, wrapper, saved in self._hooks:
+            self._restore(obj, name, saved)
 
-        if joint is None:
-            return None
+        self._hooks = list()
+        self._stages = list()
 
-        if field is not None:
-            return joint[field]
+    def _hook(self, hooks, obj, name, wrapper):
+        hooks.append((obj, name, wrapper, vars(obj).get(name, self.MISSING)))
+        setattr(obj, name, wrapper)
 
-        return joint
+    def _restore(self, obj, name, saved):
+        if saved is self.MISSING:
+            vars(obj).pop(name, None)
+        else:
+            setattr(obj, name, saved)
 
-    def has_join(self, name) -> bool:
-        return name in self.joins.keys()
+    def _arm(self, armed):
+        if armed == self.armed:
+            return
 
+        for obj, name, wrapper, saved in self._stages:
+            if armed:
+                setattr(obj, name, wrapper)
+            else:
+                self._restore(obj, name, saved)
 
-class CSVFile(object):
-    def __init__(self, **kwargs):
-        self._fields = list()
+        self.armed = armed
 
-        self.file_name = kwargs.pop("file")
-        self.file_handle = None
-        self.format = dict(delimiter=";", quotechar='"')
-        self.encoding = kwargs.pop("encoding", "utf-8")
-        self.aliases = kwargs.pop("aliases", dict())
-        self.fields = kwargs.pop("fields", list())
-        self.converter = kwargs.pop("converter", dict())
-        self.base_csv = None
-        self.name = kwargs.pop("name", None)
+    def _unit(self, function, size):
+        timed = self.wrap("create_row", function)
 
-        if "format" in kwargs:
-            self.format.update(kwargs.pop("format"))
+        def unit(data):
+            if self._creating:
+                # create_rows falling back to create_row
+                return function(data)
 
-        if len(kwargs) > 0:
-            raise KeyError("Invalid option: %s" % ", ".join(kwargs.keys()))
+            sampled = not self._units % self.sample
+            self._units += 1
+            rows = size(data)
+            self.created += rows
 
-    @property
-    def fields(self):
-        return self._fields
+            if sampled:
+                self.sampled += rows
 
-    @fields.setter
-    def fields(self, lst):
-        fields = list()
-        for field in lst:
-            if field in self.aliases:
-                fields.append(self.aliases[field])
-            else:
-                fields.append(field)
+            self._arm(sampled)
+            self._creating = True
 
-        self._fields = fields
+            try:
+                return (timed if sampled else function)(data)
+            finally:
+                self._creating = False
 
-    def begin(self):
-        pass
+        return unit
 
-    def end(self):
-        self.file_handle.close()
+    def wrap(self, stage, function):
+        clock = time.perf_counter
+        times, calls = self.times, self.calls
 
-    def _reduce_fields(self, row: dict) -> dict:
-        return {k: v for k, v in row.items() if k in self.fields}
+        times.setdefault(stage, 0.0)
+        calls.setdefault(stage, 0)
 
+        def wrapper(*args, **kwargs):
+            t = clock()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                times[stage] += clock() - t
+                calls[stage] += 1
 
-class CSVReadFile(CSVFile):
-    def __init__(self, **kwargs):
-        self._joins = dict()
-        self.joins = kwargs.pop("joins", list())
+        return wrapper
 
-        super().__init__(**kwargs)
+    def seconds(self, stage) -> float:
+        if not self.sampled:
+            return 0.0
 
-    @property
-    def joins(self):
-        return self._joins
+        return self.times[stage] * self.created / self.sampled
 
-    @joins.setter
-    def joins(self, joins):
-        if not hasattr(joins, "__iter__"):
-            joins = (joins, )
+    def estimated_calls(self, stage) -> int:
+        if not self.sampled:
+            return 0
 
-        self._joins = dict()
-        for join in joins:
-            self._joins[join.name] = join
+        return round(self.calls[stage] * self.created / self.sampled)
 
-    def __iter__(self):
-        return self.base_csv
+    def position(self):
+        offset = self.reader.offset
 
-    def check_header(self, header):
-        if self.fields is None:
-            return True
+        if offset is None:
+            try:
+                offset = self.reader.file_handle.buffer.tell()
+            except (AttributeError, OSError, ValueError):
+                return None
+
+        return offset
+
+    def check_progress(self):
+        if not self.progress:
+            return
+
+        now = time.perf_counter()
+        if now >= self._next_progress:
+            self._next_progress = now + self.progress
+            self.print_progress(now)
+
+    def print_progress(self, now):
+        rows = self.rows
+        elapsed = now - self.started
+        line = "%d rows, %.0f rows/s" % (rows, rows / elapsed if elapsed else 0)
+
+        position = self.position() if self.size else None
+        if position:
+            remaining = elapsed * (self.size - position) / position
+            line += ", %.1f%%, ETA %d:%02d:%02d" % (100.0 * position / self.size, remaining // 3600,
+                                                    remaining % 3600 // 60, remaining % 60)
+
+        line += ", peak RSS %.1f MB" % (peak_rss_kb() / 1024)
+        print(line, file=self.stream or sys.stderr)
+
+    def report(self) -> dict:
+        elapsed = time.perf_counter() - self.started
+        rows = self.rows
+
+        return dict(
+            rows=rows,
+            seconds=elapsed,
+            rows_per_second=rows / elapsed if elapsed else None,
+            peak_rss_kb=peak_rss_kb(),
+            sample=self.sample,
+            stages={stage: dict(seconds=self.seconds(stage), calls=self.estimated_calls(stage))
+                    for stage in self.calls if not stage.startswith("join:")},
+            joins={stage[5:]: dict(seconds=self.seconds(stage), calls=self.estimated_calls(stage))
+                   for stage in self.calls if stage.startswith("join:")},
+        )
+
+    def finish(self) -> dict:
+        """
+        Put back the wrapped methods, return the summary and write it to
+        ``summary`` as JSON if set.
+        """
+        self.uninstall()
+        report = self.report()
 
-        header = list(header)
-        fields = list(self.fields)
+        if self.progress:
+            self.print_progress(time.perf_counter())
 
-        for field in fields:
-            if field not in header:
-                raise CSVHeaderError(field, header)
+        if self.summary is not None:
+            import json
 
-        return True
+            with open(self.summary, "w") as f:
+                json.dump(report, f, indent=2)
 
-    def create_row(self, data) -> CSVRow:
-        for field, converter in self.converter.items():
-            data[field] = converter(data[field])
+        return report
 
-        return CSVRow(self._reduce_fields(data), self.joins, self.aliases, self.name)
 
-    @property
-    def reader(self) -> csv.DictReader:
-        if not self.base_csv:
-            self.file_handle = open(self.file_name, "r", encoding=self.encoding)
-            self.base_csv = csv.DictReader(self.file_handle, **self.format)
+class ProfiledIterator(object):
+    """
+    Iterator wrapper counting the records, timing ``next()`` while the
+    profiler samples and driving its progress output. Other attributes, like
+    ``offset``, are taken from the wrapped iterator.
+    """
+    def __init__(self, iterator, profiler):
+        self.iterator = iterator
+        self.profiler = profiler
 
-        return self.base_csv
+    def __iter__(self):
+        return self
 
-    def begin(self):
-        if self.fields is None:
-            self.fields = self.reader.fieldnames
+    def __next__(self):
+        profiler = self.profiler
+
+        if profiler.armed:
+            t = time.perf_counter()
+            record = next(self.iterator)
+            profiler.times["parse"] += time.perf_counter() - t
+            profiler.calls["parse"] += 1
         else:
-            self.check_header(self.reader.fieldnames)
+            record = next(self.iterator)
 
-        for join in self.joins.values():
-            join.begin()
+        profiler.rows += 1
+        if not profiler.rows & 1023:
+            profiler.check_progress()
 
-    def end(self):
-        super().end()
-        for join in self.joins.values():
-            join.end()
+        return record
 
+    def __getattr__(self, item):
+        return getattr(self.iterator, item)
 
-class CSVWriteFile(CSVFile):
-    def __init__(self, **kwargs):
-        self.formatter = kwargs.pop("formatter", dict())
 
-        if "name" not in kwargs:
-            kwargs["name"] = "target"
+def peak_rss_kb() -> int:
+    """
+    Peak resident memory of this process in KiB (0 where unavailable).
+    """
+    try:
+        import resource
+    except ImportError:
+        return 0
 
-        super().__init__(**kwargs)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == "darwin" else rss
 
-    @property
-    def writer(self) -> csv.DictWriter:
-        if not self.base_csv:
-            self.file_handle = open(self.file_name, "w", encoding=self.encoding)
-            self.base_csv = csv.DictWriter(self.file_handle, self.fields, **self.format)
 
-        return self.base_csv
+class Checkpoint(object):
+    """
+    Progress of a run saved every ``every`` rows: the input and output byte
+    offsets, the statistics and the state returned by
+    ``Controller.get_state()``. Requires an uncompressed input and output.
+    """
+    def __init__(self, file_name, every=100000):
+        self.file_name = file_name
+        self.every = every
 
-    @CSVFile.fields.setter
-    def fields(self, val):
-        self._fields = val
+    def save(self, controller, reader, writer):
+        import pickle
 
-    def write(self, data):
-        data = dict(data)
+        state = dict(
+            input=(reader.file_name, os.path.getsize(reader.file_name)),
+            input_offset=reader.offset,
+            output_offset=writer.tell(),
+            statistics=controller.statistics,
+            controller=controller.get_state(),
+        )
 
-        for field, formatter in self.formatter.items():
-            data[field] = formatter(data[field])
+        temp = self.file_name + ".tmp"
+        with open(temp, "wb") as handle:
+            pickle.dump(state, handle)
 
-        self.writer.writerow(self._reduce_fields(data))
+        os.replace(temp, self.file_name)
 
-    def writeheader(self):
-        self.writer.writeheader()
+    def load(self, reader) -> dict:
+        import pickle
 
-    def _reduce_fields(self, row: dict):
-        result = dict()
+        try:
+            with open(self.file_name, "rb") as handle:
+                state = pickle.load(handle)
+        except FileNotFoundError:
+            raise CSVError("No checkpoint found at '%s'" % self.file_name)
 
-        for k, v in row.items():
-            if k in self.fields:
-                result[k] = v
+        if state["input"] != (reader.file_name, os.path.getsize(reader.file_name)):
+            raise CSVError("Checkpoint '%s' was written for a different input" % self.file_name)
 
-            if k in self.aliases:
-                result[self.aliases[k]] = v
+        return state
 
-        return result
+    @staticmethod
+    def restore(controller, state):
+        controller.statistics = state["statistics"]
+        controller.set_state(state["controller"])
 
+    def remove(self):
+        if os.path.exists(self.file_name):
+            os.remove(self.file_name)
 
-class JoinCSV(CSVReadFile):
-    def __init__(self, **kwargs):
-        self.local_field = kwargs.pop("local")
-        self.join_field = kwargs.pop("remote")
 
-        self.cache_enabled = kwargs.pop("cache", True)
-        self.cache = dict()
+def controller_signature(controller) -> str:
+    """
+    Fingerprint of everything besides the input that determines a
+    controller's output: the source of its module and the size and mtime of
+    all join files.
+    """
+    import hashlib
+    import inspect
 
-        if "name" not in kwargs:
-            kwargs["name"] = kwargs["file"]
+    digest = hashlib.sha256()
 
-        super().__init__(**kwargs)
+    try:
+        digest.update(inspect.getsource(inspect.getmodule(type(controller))).encode())
+    except (OSError, TypeError):
+        digest.update(type(controller).__qualname__.encode())
 
-    def get_row(self, criteria) -> CSVRow:
-        if self.cache_enabled:
-            f = self.get_row_cached
-        else:
-            f = self.get_row_uncached
+    digest.update(repr(sorted(controller.output.get("fields") or ())).encode())
 
-        data = f(criteria)
+    for join in walk_joins(controller.reader.joins):
+        stat = os.stat(join.file_name)
+        digest.update(repr((join.file_name, stat.st_size, stat.st_mtime_ns)).encode())
 
-        return data
+    return digest.hexdigest()
 
-    def get_row_uncached(self, criteria) -> dict:
-        for row in self.reader:
-            if self._is_match(row, criteria):
-                return self.create_row(row)
 
-    def get_row_cached(self, criteria) -> dict:
-        if criteria in self.cache:
-            return self.cache[criteria]
+class IncrementalState(object):
+    """
+    Per-row fingerprints and output of the previous run, kept in a sqlite
+    file. Rows are keyed by the primary key field(s); the fingerprint covers
+    the raw values of all columns the reader uses. The state is discarded
+    when ``signature`` differs from the one it was written with, and only
+    replaced when a run completes.
+    """
+    MISSING = object()
 
-        for row in self.reader:
-            r = self.create_row(row)
-            self.cache[row[self.join_field]] = r
+    def __init__(self, file_name, primary_key, signature):
+        if primary_key is None:
+            raise CSVError("Incremental runs require Controller.primary_key")
 
-            if self._is_match(r, criteria):
-                return r
+        self.file_name = file_name
+        self.primary_key = primary_key if isinstance(primary_key, (tuple, list)) else (primary_key, )
+        self.signature = signature
 
-    def auto_join(self, row: CSVRow) -> CSVRow:
-        criteria = row[self.local_field]
-        return self.get_row(criteria)
+        self.db = None
+        self.batch = list()
+        self._key_indices = None
+        self._columns = None
 
-    def _is_match(self, row, criteria) -> bool:
-        return row[self.join_field] == criteria
+    def begin(self, header, projection: set):
+        """
+        Open the state file for a reader with the given header. The primary
+        key columns are added to the reader's ``projection``.
+        """
+        import sqlite3
 
+        for field in self.primary_key:
+            if field not in header:
+                raise CSVHeaderError(field, header)
 
-class Statistics(object):
-    class Counter(object):
-        def __init__(self, allow_negative=True):
-            self.slots = dict()
-            self.allow_negative = allow_negative
+        self._key_indices = [header.index(field) for field in self.primary_key]
+        projection.update(self._key_indices)
+        self._columns = sorted(set(projection) | set(self._key_indices))
 
-        def plus(self, slot, n=1):
-            try:
-                self.slots[slot] += n
-            except KeyError:
-                self.slots[slot] = n
+        self.db = db = sqlite3.connect(self.file_name)
+        db.execute("CREATE TABLE IF NOT EXISTS meta (signature TEXT)")
+        db.execute("CREATE TABLE IF NOT EXISTS rows (key TEXT PRIMARY KEY, fingerprint BLOB, output BLOB)")
+        db.execute("DROP TABLE IF EXISTS rows_new")
+        db.execute("CREATE TABLE rows_new (key TEXT PRIMARY KEY, fingerprint BLOB, output BLOB)")
 
-            if not self.allow_negative and self[slot] < 0:
-                self.slots[slot] = 0
+        current = db.execute("SELECT signature FROM meta").fetchone()
+        if current is None or current[0] != self.signature:
+            db.execute("DELETE FROM rows")
 
-        def minus(self, slot, n=1):
-            self.plus(slot, -n)
+    def lookup(self, record: list):
+        """
+        Return (key, fingerprint, output) for a raw record, where output is
+        the previous output row, None if the row was not written or
+        ``MISSING`` if the row is new or changed.
+        """
+        import hashlib
+        import pickle
 
-        def __getitem__(self, item):
-            return self.slots.get(item, 0)
+        width = len(record)
+        key = "\x1f".join(str(record[i]) if i < width else "" for i in self._key_indices)
+        values = "\x1f".join(str(record[i]) if i < width else "" for i in self._columns)
+        fingerprint = hashlib.blake2b(values.encode(), digest_size=16).digest()
 
-    def __init__(self):
-        self.changes = {}
-        self.rows = 0
+        previous = self.db.execute("SELECT fingerprint, output FROM rows WHERE key = ?", (key, )).fetchone()
 
-    def process(self, data):
-        changed = False
-        for field in data.origin.keys():
-            if data.origin[field] != data[field]:
-                changed = True
-                self._incr("changes", field)
+        if previous is None or previous[0] != fingerprint:
+            return key, fingerprint, self.MISSING
 
-        if changed:
-            self.rows += 1
+        return key, fingerprint, None if previous[1] is None else pickle.loads(previous[1])
 
-    def finish(self):
-        import operator
-        print("Finished, modified %d rows." % self.rows)
-        s = sorted(self.changes.items(), key=operator.itemgetter(1))
+    def store(self, key, fingerprint, output):
+        import pickle
 
-        for field, changes in s:
-            print("%6d %s" % (changes, field))
+        self.batch.append((key, fingerprint, None if output is None else pickle.dumps(output)))
 
-    def _incr(self, prop, index, n=1):
-        try:
-            self.__dict__[prop][index] += n
-        except KeyError:
-            self.__dict__[prop][index] = n
+        if len(self.batch) >= 10000:
+            self._flush()
+
+    def _flush(self):
+        self.db.executemany("INSERT OR REPLACE INTO rows_new VALUES (?, ?, ?)", self.batch)
+        self.batch = list()
+
+    def end(self):
+        self._flush()
+        self.db.execute("DROP TABLE rows")
+        self.db.execute("ALTER TABLE rows_new RENAME TO rows")
+        self.db.execute("DELETE FROM meta")
+        self.db.execute("INSERT INTO meta VALUES (?)", (self.signature, ))
+        self.db.commit()
+        self.db.close()
+
+    def abort(self):
+        self.db.rollback()
+        self.db.close()
 
 
 class Controller(object):
+    """
+    Describes the work to be done on a feed. Implement ``handle(row)`` to
+    process one ``CSVRow`` at a time, or ``handle_batch(batch)`` to process
+    ``batch_size`` rows at once as columns of a ``CSVBatch``. An
+    ``async def handle(row)`` is run by ``AsyncCSVMod`` with up to
+    ``concurrency`` rows in flight.
+    """
     statistics = [Statistics()]
     settings = dict()
     output = dict()
+    batch_size = 10000
+    concurrency = 16
+    primary_key = None
 
     def __init__(self, input_file=None, output_file=None):
+        self.settings = dict(self.settings)
+        self.output = dict(self.output)
+
         if input_file is not None:
             self.settings["file"] = input_file
 
@@ -385,6 +3654,16 @@ class Controller(object):
     def handle(self, data):
         pass
 
+    def get_state(self):
+        """
+        Return the controller state to save in checkpoints. It must be
+        picklable and is passed to ``set_state()`` when a run is resumed.
+        """
+        return None
+
+    def set_state(self, state):
+        pass
+
     @property
     def reader(self) -> CSVReadFile:
         if not self._reader:
@@ -405,7 +3684,15 @@ class Controller(object):
             if "name" not in opts:
                 opts["name"] = "main"
 
-            self._writer = CSVWriteFile(**opts)
+            if "schema" not in opts and "converter" not in opts:
+                opts["schema"] = self.reader.schema
+
+            if opts.get("backend", "csv") == "csv":
+                opts.pop("backend", None)
+                self._writer = CSVWriteFile(**opts)
+            else:
+                opts.setdefault("converter", self.reader.converter)
+                self._writer = ArrowWriteFile(**opts)
 
         return self._writer
 
@@ -413,41 +3700,163 @@ class Controller(object):
         for stat in self.statistics:
             stat.process(data)
 
+    def close(self):
+        """
+        Close the input and flush and close the output, without reporting.
+        """
+        try:
+            if self._writer is not None:
+                self._writer.end()
+        finally:
+            if self._reader is not None:
+                self._reader.end()
+
     def finish(self):
-        self._reader.end()
+        self.close()
 
         for stat in self.statistics:
             stat.finish()
+            stat.finish_joins(self._reader.joins)
 
 
-if __name__ == "__main__":
-    from sys import argv, path
-    from os import getcwd
+CO_COROUTINE = 0x80
 
-    def import_controller(name):
-        components = name.split('.')
-        module = __import__(components[0])
-        for comp in components[1:]:
-            module = getattr(module, comp)
 
-        return module
+def is_coroutine_function(function) -> bool:
+    """
+    ``inspect.iscoroutinefunction`` for plain functions and methods, without
+    importing ``inspect`` on startup.
+    """
+    code = getattr(getattr(function, "__func__", function), "__code__", None)
+    return code is not None and bool(code.co_flags & CO_COROUTINE)
+
+
+def import_controller(name):
+    """
+    Import a controller class given as ``module.Class``, looking for the
+    module in the working directory as well.
+    """
+    import importlib
+
+    if os.getcwd() not in sys.path:
+        sys.path.append(os.getcwd())
+
+    module, _, attribute = name.rpartition(".")
+    return getattr(importlib.import_module(module), attribute)
 
-    if len(argv) != 4:
-        print("Usage: %s <controller> <input> <output>" % argv[0])
-        exit(1)
 
-    controller_name = argv[1]
-    read_file = argv[2]
-    write_file = argv[3]
+def argument_parser(**kwargs):
+    from argparse import ArgumentParser, HelpFormatter
 
-    path.append(getcwd())
-    chosen_controller = import_controller(controller_name)
+    def formatter(prog):
+        # with the default width argparse imports shutil, and that bz2 and lzma
+        return HelpFormatter(prog, width=int(os.environ.get("COLUMNS", 80)) - 2)
+
+    return ArgumentParser(formatter_class=formatter, **kwargs)
+
+
+def build_index_files(argv):
+    parser = argument_parser(prog="csvmod.py index",
+                             description="Build the offset index files of a controller's index strategy joins.")
+    parser.add_argument("controller", help="controller class, e.g. demo.DemoController1")
+    parser.add_argument("--join", action="append", metavar="NAME",
+                        help="only build the index of this join (default: all joins with strategy 'index')")
+    parser.add_argument("--force", action="store_true", help="rebuild up to date indexes")
+    args = parser.parse_args(argv)
+
+    joins = import_controller(args.controller).settings.get("joins", ())
+    if not isinstance(joins, (tuple, list)):
+        joins = (joins, )
+
+    for join in walk_joins({join.name: join for join in joins}):
+        if join.strategy != "index" or (args.join and join.name not in args.join):
+            continue
+
+        try:
+            built = join.build_index_file(args.force)
+        finally:
+            join.end()
 
-    mod = CSVMod(chosen_controller(read_file, write_file))
+        print("%s: %s %s" % (join.name, "built" if built else "up to date", join.index))
+
+
+def main(argv=None):
+    started = time.perf_counter()
+    timings = [("startup (CPU)", time.process_time())]
+    argv = sys.argv[1:] if argv is None else argv
+
+    if argv[:1] == ["index"]:
+        return build_index_files(argv[1:])
+
+    parser = argument_parser(description="Programmatically modify csv files.")
+    parser.add_argument("controller", help="controller class, e.g. demo.DemoController1")
+    parser.add_argument("input", help="input csv file")
+    parser.add_argument("output", help="output csv file")
+    parser.add_argument("-j", "--processes", type=int, default=1,
+                        help="number of worker processes (default: 1)")
+    parser.add_argument("--checkpoint", metavar="FILE",
+                        help="save the progress to FILE (default with --resume: <output>.checkpoint)")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue an interrupted run from its checkpoint")
+    parser.add_argument("--incremental", metavar="STATE",
+                        help="only handle rows changed since the last run recorded in STATE")
+    parser.add_argument("--progress", type=float, metavar="SECONDS",
+                        help="print rows/s, ETA and memory to stderr every SECONDS")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="write the time spent per stage and join to FILE as JSON")
+    parser.add_argument("--sample", type=int, default=1, metavar="N",
+                        help="only time every N-th row when profiling (default: 1)")
+    parser.add_argument("--fan-out", nargs=2, action="append", default=[], metavar=("CONTROLLER", "OUTPUT"),
+                        help="also run CONTROLLER into OUTPUT in the same pass over the input (repeatable)")
+    parser.add_argument("--import-time", action="store_true",
+                        help="print the time spent starting up, importing and setting up the controller to stderr")
+    args = parser.parse_args(argv)
+
+    if args.fan_out and (args.incremental or args.checkpoint or args.resume or args.progress or args.profile or
+                         args.processes > 1):
+        parser.error("--fan-out can not be combined with incremental, checkpointed, profiled or parallel runs")
+
+    modules = len(sys.modules)
+    t = time.perf_counter()
+
+    chosen_controller = import_controller(args.controller)
+    others = [(import_controller(name), output) for name, output in args.fan_out]
+    timings.append(("controller import (%d modules)" % (len(sys.modules) - modules), time.perf_counter() - t))
+
+    if not args.fan_out and is_coroutine_function(chosen_controller.handle) and \
+            (args.incremental or args.checkpoint or args.resume):
+        parser.error("controllers with an async handle() can not be combined with incremental or checkpointed runs")
+
+    t = time.perf_counter()
+
+    profiler = None
+    if args.progress or args.profile:
+        profiler = Profiler(sample=args.sample, progress=args.progress, summary=args.profile)
+
+    if args.fan_out:
+        mod = MultiCSVMod([chosen_controller(args.input, args.output)] + [
+            controller(args.input, output) for controller, output in others])
+    elif is_coroutine_function(chosen_controller.handle):
+        mod = AsyncCSVMod(chosen_controller(args.input, args.output), profiler=profiler)
+    else:
+        checkpoint = args.checkpoint or (args.output + ".checkpoint" if args.resume else None)
+        mod = CSVMod(chosen_controller(args.input, args.output), incremental=args.incremental,
+                     checkpoint=checkpoint, resume=args.resume, profiler=profiler)
+
+    timings.append(("controller setup", time.perf_counter() - t))
+    t = time.perf_counter()
 
     try:
-        mod.start()
+        mod.start(processes=args.processes)
     except CSVHeaderError as e:
         print("Unexpected header detected.")
         print(e.expected)
         print(e.actual)
+        return 1
+    finally:
+        if args.import_time:
+            timings.append(("run", time.perf_counter() - t))
+            timings.append(("total since main()", time.perf_counter() - started))
+
+            for label, seconds in timings:
+                print("%-32s %8.1f ms" % (label, seconds * 1000), file=sys.stderr)
@@ -94,3 +94,30 @@ class DemoController2(Controller):
     def handle(self, data):
         data["Shipping"] = data["ArticleNo"] + data["DispatchTime"]
         data["ArticleNo"] = 1234
+
+
+class DemoBatchController(Controller):
+    """
+    Moves the shipping costs into the price for expensive items, working on
+    whole columns instead of single rows.
+    """
+    settings = dict(
+        converter={
+            "Price": comma_decimal,
+            "Shipping": comma_decimal
+        },
+        fields=("ItemNo", "Price", "Shipping"),
+    )
+    output = dict(
+        formatter={
+            "Price": comma_decimal_formatter,
+            "Shipping": comma_decimal_formatter,
+        },
+    )
+
+    def handle_batch(self, batch: CSVBatch):
+        price, shipping = batch["Price"], batch["Shipping"]
+        expensive = [p >= 40 for p in price]
+
+        batch["Price"] = [p + s if e else p for p, s, e in zip(price, shipping, expensive)]
+        batch["Shipping"] = [0 if e else s for s, e in zip(shipping, expensive)]
@@ -1,6 +1,9 @@
+import os
 import pickle
+import tempfile
 from unittest import TestCase
 from csvmod import *
+import unittest
 import unittest.main
 from unittest import mock
 
@@ -69,6 +72,25 @@ class TestCSVRow(TestCase):
         self.assertEqual(False, row.is_changed)
         row["foo"] = "something else"
         self.assertEqual(True, row.is_changed)
+        self.assertEqual(["foo"], row.changed_fields())
+        self.assertEqual(self.f, row.origin)
+
+        row = CSVRow(dict(self.f), dict(), dict())
+        row["new"] = 1
+        self.assertEqual(True, row.is_changed)
+        self.assertEqual([], row.changed_fields())
+        self.assertEqual(self.f, row.origin)
+
+    def test_statistics(self):
+        stats = Statistics()
+        for row in (CSVRow(dict(self.f), dict(), dict()), CompactRow(["bar", "foo"], RowLayout(("foo", "bar"), dict(), dict()))):
+            stats.process(row)
+            row["foo"] = "baz"
+            row["bar"] = "foo"
+            stats.process(row)
+
+        self.assertEqual(2, stats.rows)
+        self.assertEqual({"foo": 2}, stats.changes)
 
     def test_has_join(self):
         row = CSVRow(dict(self.f), {"foo": None, "bar": None}, dict())
@@ -85,6 +107,163 @@ class TestCSVRow(TestCase):
         self.assertEqual("jbar", row.join("foo", "jfoo"))
 
 
+class TestCompactRow(TestCase):
+    def row(self, joins=None):
+        return CompactRow(["bar", "foo"], RowLayout(("foo", "bar"), joins or dict(), {"f": "foo"}, "file"))
+
+    def test_item_accessor(self):
+        row = self.row()
+        self.assertEqual("bar", row["foo"])
+        self.assertEqual("bar", row["f"])
+        self.assertRaises(CSVFieldError, row.__getitem__, "baz")
+        row["f"] = "baz"
+        self.assertEqual("baz", row["foo"])
+        self.assertEqual({"foo": "baz", "bar": "foo"}, row.fields)
+        self.assertEqual({"foo": "bar", "bar": "foo"}, row.origin)
+        self.assertFalse(hasattr(row, "__dict__"))
+
+    def test_is_changed(self):
+        row = self.row()
+        self.assertEqual(False, row.is_changed)
+        row["foo"] = "bar"
+        self.assertEqual(False, row.is_changed)
+        row["foo"] = "something else"
+        self.assertEqual(True, row.is_changed)
+        row["foo"] = "bar"
+        self.assertEqual(False, row.is_changed)
+        row["new"] = 1
+        self.assertEqual(True, row.is_changed)
+        self.assertEqual(1, row["new"])
+
+    def test_join(self):
+        jmock = JoinCSVMock()
+        row = self.row({"foo": jmock})
+        self.assertTrue(row.has_join("foo"))
+        self.assertEqual("jbar", row.join("foo", "jfoo"))
+        self.assertRaises(CSVError, row.join, "bar")
+
+    def test_create_row(self):
+        c = CSVReadFile(file="", converter={"foo": int}, fields=("foo", "bar"), compact=True)
+        a = c.create_row({"foo": "1", "bar": "x", "baz": "y"})
+        b = c.create_row({"foo": "2", "bar": "z", "baz": "y"})
+        self.assertIsInstance(a, CompactRow)
+        self.assertIs(a.layout, b.layout)
+        self.assertEqual({"foo": 2, "bar": "z"}, b.fields)
+
+
+class TestColumnTypes(TestCase):
+    def test_column_type(self):
+        self.assertIsInstance(column_type("int"), IntColumn)
+        self.assertEqual("%d.%m.%Y", column_type("date:%d.%m.%Y").date_format)
+        self.assertEqual(("a", "b"), column_type(("a", "b")).allowed)
+        self.assertIsInstance(column_type(comma_decimal), CallableColumn)
+        self.assertRaises(CSVError, column_type, "decimal")
+        self.assertRaises(CSVError, column_type, "int:8")
+        self.assertRaises(CSVError, CSVReadFile, file="", converter={"a": int}, schema={"a": "int"})
+
+    def test_convert(self):
+        import datetime
+
+        self.assertEqual([1, 2], column_type("int").convert(["1", "2"]))
+        self.assertEqual([1, None, None, 5], column_type("int").convert(["1", "", None, 5]))
+        self.assertRaises(CSVError, column_type("int").convert, ["1", "x"])
+        self.assertEqual([1, 3.9], column_type("int").convert(["1", 3.9]))
+        self.assertEqual([3.9], column_type("int").convert([3.9]))
+        self.assertIs(int, type(column_type("float").convert([5])[0]))
+        self.assertEqual([1.5, 2.0], column_type("comma_float").convert(["1,5", "2"]))
+        self.assertEqual([True, False, None], column_type("bool").convert(["Yes", "0", ""]))
+        self.assertEqual([datetime.date(2024, 2, 29)] * 2,
+                         column_type("date").convert(["2024-02-29"]) + column_type("date:%d.%m.%Y").convert(["29.02.2024"]))
+
+        a, b = "".join(["a", "b"]), "".join(["a", "b"])
+        self.assertIsNot(a, b)
+        values = column_type("category").convert([a, b])
+        self.assertIs(values[0], values[1])
+
+        self.assertEqual(["a", None, None], column_type("category").convert(["a", "", None]))
+        self.assertIsNone(column_type("category").convert_value(""))
+        self.assertEqual(["a", None], column_type(["a", "b"]).convert(["a", ""]))
+        self.assertRaises(CSVError, column_type(["a", "b"]).convert, ["c"])
+
+    def test_create_rows(self):
+        schema = {"id": "int", "price": "comma_float", "group": "category"}
+        records = [["1", "1,5", "a", "x", "n"], ["2", "", "b", "y", "n"], ["3", "2", "a", "z"]]
+
+        for compact in (False, True):
+            c = CSVReadFile(file="", schema=schema, converter={"name": str.upper}, compact=compact)
+            c.prepare(["id", "price", "group", "name", "note"])
+
+            rows = [r.fields for r in c.create_rows(records)]
+            self.assertEqual([c.create_row(list(r)).fields for r in records], rows)
+            self.assertEqual({"id": 2, "price": None, "group": "b", "name": "Y", "note": "n"}, rows[1])
+            self.assertIsNone(rows[2]["note"])
+
+    def test_write(self):
+        import datetime
+
+        c = CSVWriteFile(file="", fields=["p", "b", "d", "n"], schema={"p": "comma_float", "b": "bool", "d": "date:%d.%m.%Y"})
+        c.base_csv = mock.Mock(spec=csv.DictWriter)
+        c.write({"p": 1.5, "b": True, "d": datetime.date(2024, 1, 2), "n": 1})
+        c.base_csv.writerow.assert_called_once_with({"p": "1,5", "b": "1", "d": "02.01.2024", "n": 1})
+
+
+class TestCSVBatch(TestCase):
+    def rows(self):
+        return [CSVRow({"price": p, "name": n}, dict(), {"n": "name"}) for p, n in ((1.5, "a"), (40.0, "b"), (50.0, "c"))]
+
+    def test_columns(self):
+        batch = CSVBatch(self.rows(), {"n": "name"})
+        self.assertEqual(3, len(batch))
+        self.assertEqual(["a", "b", "c"], list(batch["n"]))
+        self.assertEqual([1.5, 40.0, 50.0], list(batch["price"]))
+        self.assertRaises(CSVFieldError, batch.__getitem__, "foo")
+        self.assertRaises(CSVError, batch.__setitem__, "price", [1])
+
+    def test_apply(self):
+        batch = CSVBatch(self.rows())
+        self.assertEqual([], batch.apply())
+
+        batch["price"] = [p + 1 if p >= 40 else p for p in batch["price"]]
+        rows = batch.apply()
+        self.assertEqual([41.0, 51.0], [r["price"] for r in rows])
+        self.assertTrue(all(r.is_changed for r in rows))
+
+        batch = CSVBatch(self.rows())
+        batch["name"][1] = "B"
+        self.assertEqual(["B"], [r["name"] for r in batch.apply()])
+
+        batch = CSVBatch(self.rows())
+        self.assertEqual(["a", "c"], [r["name"] for r in batch.apply([True, False, True])])
+        self.assertEqual(3, len(batch.apply(True)))
+        self.assertEqual([], batch.apply(False))
+        self.assertRaises(CSVError, batch.apply, 1)
+        self.assertRaises(CSVError, batch.apply, [True])
+
+    def test_create_batch(self):
+        c = CSVReadFile(file="", fields=("id", "price", "name"), converter={"price": comma_decimal})
+        c.compile(["id", "price", "name"])
+        records = [["1", "1,5", "a"], ["2", "40", "b"], ["3", "50", "c"]]
+
+        with mock.patch.object(c, "make_row", wraps=c.make_row) as make_row:
+            batch = c.create_batch(records)
+            self.assertEqual([1.5, 40.0, 50.0], list(batch["price"]))
+
+            batch["price"] = [p + 1 if p >= 40 else p for p in batch["price"]]
+            rows = batch.apply()
+            self.assertEqual(2, make_row.call_count)
+
+        self.assertEqual([{"id": "2", "price": 41.0, "name": "b"}, {"id": "3", "price": 51.0, "name": "c"}],
+                         [r.fields for r in rows])
+        self.assertEqual([["price"], ["price"]], [list(r.changed_fields()) for r in rows])
+        self.assertEqual(3, len(c.create_batch(records).apply(True)))
+
+        batch = c.create_batch(records)
+        self.assertEqual("a", batch.rows[0]["name"])
+        batch["name"] = ["x", "b", "c"]
+        self.assertEqual([batch.rows[0]], batch.apply())
+        self.assertEqual("x", batch.rows[0]["name"])
+
+
 class TestCSVFile(TestCase):
     def test___init__(self):
         self.assertRaises(KeyError, CSVFile)
@@ -137,6 +316,113 @@ class TestCSVReadFile(TestCase):
         self.assertEqual(r["baz"], "321")
 
 
+    def test_compiled_create_row(self):
+        c = CSVReadFile(file="", converter={"foo": int, "baz": int}, fields=("bar", "foo"), compact=False)
+        c.compile(["baz", "foo", "bar"])
+        r = c.create_row(["x", "123", "12.34"])
+        self.assertEqual({"foo": 123, "bar": "12.34"}, r.fields)
+        self.assertEqual({"foo": 123, "bar": None}, c.create_row(["x", "123"]).fields)
+
+        c.compact = True
+        self.assertEqual({"foo": 1, "bar": "2"}, c.create_row(["x", "1", "2"]).fields)
+
+    def test_filter(self):
+        records = [["u01", "5", "a"], ["u02", "12,5", "b"], ["x01", "7", "a"], ["u03", "n/a", "c"], ["u04", "3"], []]
+        c = CSVReadFile(file="", converter={"price": comma_decimal}, aliases={"no": "ItemNo"},
+                        filter={"no": dict(prefix=("u0", "v0")), "price": dict(min=4, max=20)})
+        c.compile(["ItemNo", "price", "group"])
+        c.base_csv = iter(records)
+        self.assertEqual(["u01", "u02"], [r[0] for r in c])
+
+        c.filter = {"group": {"in": ("a", "c")}, "ItemNo": lambda v: v != "u03"}
+        c.compile(["ItemNo", "price", "group"])
+        c.base_csv = iter(records)
+        self.assertEqual(["u01", "x01"], [r[0] for r in c])
+
+        c.filter = {"missing": dict(eq="1")}
+        self.assertRaises(CSVHeaderError, c.compile, ["ItemNo"])
+        c.filter = {"ItemNo": dict(like="u%")}
+        self.assertRaises(CSVError, c.compile, ["ItemNo"])
+
+    def test_begin(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            file = os.path.join(tmp, "input.csv")
+            with open(file, "w", encoding="utf-8") as f:
+                f.write("foo;bar\n1;2\n")
+
+            c = CSVReadFile(file=file)
+            c.begin()
+            self.assertEqual(["foo", "bar"], c.fields)
+            self.assertEqual([{"foo": "1", "bar": "2"}], [c.create_row(data).fields for data in c])
+            c.end()
+
+            c = CSVReadFile(file=file, fields=("baz", ))
+            self.assertRaises(CSVHeaderError, c.begin)
+            c.end()
+
+
+    def test_mmap(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            file = os.path.join(tmp, "input.csv")
+            with open(file, "w", encoding="utf-8", newline="") as f:
+                f.write('id;name;note\r\n1;a;x\r\n2;"b;\nc";"y ""z"""\r\n\r\n3;ü;\n4;d')
+
+            rows = dict()
+            for mmap in (False, True):
+                c = CSVReadFile(file=file, fields=("id", "name"), mmap=mmap)
+                c.begin()
+                rows[mmap] = [c.create_row(data).fields for data in c]
+                c.end()
+
+            self.assertEqual(rows[False], rows[True])
+            self.assertEqual(["1", "2", "3", "4"], [r["id"] for r in rows[True]])
+            self.assertEqual("b;\nc", rows[True][1]["name"])
+
+            c = CSVReadFile(file=file, mmap=True)
+            offsets = [offset for offset, record in c.records_with_offsets()]
+            self.assertEqual(4, len(offsets))
+
+            c.byte_range = (offsets[1], offsets[3])
+            c.begin()
+            self.assertEqual(["2", "3"], [c.create_row(data)["id"] for data in c])
+            self.assertEqual(offsets[3], c.offset)
+            c.end()
+
+
+class TestCompression(TestCase):
+    def test_round_trip(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for extension in (".gz", ".bz2", ".xz"):
+                file = os.path.join(tmp, "data.csv" + extension)
+
+                w = CSVWriteFile(file=file, fields=["foo", "bar"], compression_level=1)
+                w.writeheader()
+                for i in range(1000):
+                    w.write({"foo": str(i), "bar": "ä"})
+                w.end()
+
+                self.assertEqual(extension[1:].replace("gz", "gzip"), detect_compression(file))
+
+                plain = os.path.join(tmp, "data")
+                os.replace(file, plain)
+                self.assertEqual(extension[1:].replace("gz", "gzip"), detect_compression(plain))
+
+                for threaded in (True, False):
+                    r = CSVReadFile(file=plain, threaded=threaded)
+                    r.begin()
+                    rows = [r.create_row(data).fields for data in r]
+                    r.end()
+
+                    self.assertEqual(1000, len(rows))
+                    self.assertEqual({"foo": "999", "bar": "ä"}, rows[-1])
+
+                r = CSVReadFile(file=plain, mmap=True)
+                self.assertRaises(CSVError, r.begin)
+                self.assertRaises(CSVError, r.byte_ranges, 2)
+
+            self.assertIsNone(detect_compression(os.path.join(tmp, "missing.csv")))
+
+
 class TestCSVWriteFile(TestCase):
     def test_write(self):
         data = {"foo": "bar", "bar": "foo"}
@@ -169,11 +455,790 @@ class TestCSVWriteFile(TestCase):
         writerow.reset_mock()
 
 
+class UpperController(Controller):
+    statistics = [Statistics()]
+    settings = dict(fields=("id", "name"))
+    output = dict()
+
+    def handle(self, data):
+        if int(data["id"]) % 3 == 0:
+            return False
+
+        data["name"] = data["name"].upper()
+
+
+class AllFieldsController(Controller):
+    statistics = [Statistics()]
+    output = dict()
+
+    def handle(self, data):
+        data["name"] = data["name"].upper()
+
+
+class FeedTestCase(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.input = os.path.join(self.tmp.name, "input.csv")
+
+        with open(self.input, "w", encoding="utf-8", newline="") as f:
+            f.write("id;name\n")
+            for i in range(200):
+                f.write('%d;"row\n%d"\n' % (i, i) if i % 7 == 0 else "%d;row %d\n" % (i, i))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+
+class TestParallel(FeedTestCase):
+    def test_byte_ranges(self):
+        c = CSVReadFile(file=self.input)
+        ranges = c.byte_ranges(4)
+
+        self.assertEqual(4, len(ranges))
+        self.assertEqual(os.path.getsize(self.input), ranges[-1][1])
+
+        rows = list()
+        for r in ranges:
+            c = CSVReadFile(file=self.input, fields=("id", "name"))
+            c.byte_range = r
+            c.begin()
+            rows.extend(int(c.create_row(data)["id"]) for data in c)
+            c.end()
+
+        self.assertEqual(list(range(200)), rows)
+
+    def test_start_parallel(self):
+        serial = os.path.join(self.tmp.name, "serial.csv")
+        parallel = os.path.join(self.tmp.name, "parallel.csv")
+
+        with mock.patch("builtins.print"):
+            CSVMod(UpperController(self.input, serial)).start()
+            serial_rows = UpperController.statistics[0].rows
+            UpperController.statistics = [Statistics()]
+            CSVMod(UpperController(self.input, parallel)).start(processes=3)
+
+        with open(serial, encoding="utf-8") as a, open(parallel, encoding="utf-8") as b:
+            self.assertEqual(a.read(), b.read())
+
+        self.assertEqual(133, serial_rows)
+        self.assertEqual(serial_rows, UpperController.statistics[0].rows)
+        self.assertFalse([f for f in os.listdir(self.tmp.name) if ".part" in f])
+
+    def test_all_fields(self):
+        for processes in (1, 3):
+            output = os.path.join(self.tmp.name, "output%d.csv" % processes)
+
+            with mock.patch("builtins.print"):
+                CSVMod(AllFieldsController(self.input, output)).start(processes)
+
+            with open(output, encoding="utf-8", newline="") as f:
+                rows = list(csv.reader(f, delimiter=";"))
+
+            self.assertEqual(["id", "name"], rows[0])
+            self.assertEqual(["1", "ROW 1"], rows[2])
+            self.assertEqual(201, len(rows))
+
+    def test_start_parallel_error(self):
+        output = os.path.join(self.tmp.name, "output.csv")
+        CrashingController.crash_at = 150
+
+        try:
+            with mock.patch("builtins.print"):
+                self.assertRaises(RuntimeError, CSVMod(CrashingController(self.input, output)).start, processes=3)
+        finally:
+            CrashingController.crash_at = None
+
+        self.assertFalse([f for f in os.listdir(self.tmp.name) if ".part" in f])
+
+    def test_start_parallel_statistics(self):
+        join = os.path.join(self.tmp.name, "join.csv")
+        ranges = CSVReadFile.byte_ranges
+
+        with open(join, "w", encoding="utf-8") as f:
+            f.write("id;label\n")
+            f.writelines("%d;l%d\n" % (i, i) for i in range(200))
+
+        UpperController.statistics = [Statistics()]
+        JoinedController.statistics = [Statistics()]
+        JoinedController.settings = dict(fields=("id", "name"), joins=(
+            JoinCSV(name="disk", file=join, local="id", remote="id", fields=("label", ), strategy="disk"),
+        ))
+        JoinedController.handle = lambda self, data: data.__setitem__("name", data.join("disk", "label"))
+
+        # more parts than processes, so that a process handles several jobs
+        with mock.patch("builtins.print"), mock.patch.object(CSVReadFile, "byte_ranges", autospec=True,
+                                                             side_effect=lambda c, n: ranges(c, n * 4)):
+            CSVMod(UpperController(self.input, os.path.join(self.tmp.name, "upper.csv"))).start(processes=3)
+            controller = JoinedController(self.input, os.path.join(self.tmp.name, "joined.csv"))
+            CSVMod(controller).start(processes=3)
+
+        self.assertEqual(133, UpperController.statistics[0].rows)
+        self.assertEqual(200, JoinedController.statistics[0].rows)
+
+        stats = controller.reader.joins["disk"].stats
+        self.assertEqual(200, stats["hits"] + stats["misses"])
+        UpperController.statistics = [Statistics()]
+        del JoinedController.handle
+
+    def test_start_parallel_disk_index(self):
+        join = os.path.join(self.tmp.name, "join.csv")
+        output = os.path.join(self.tmp.name, "output.csv")
+
+        with open(join, "w", encoding="utf-8") as f:
+            f.write("id;label\n")
+            f.writelines("%d;l%d\n" % (i, i) for i in reversed(range(200)))
+
+        JoinedController.settings = dict(fields=("id", "name"), joins=(
+            JoinCSV(name="index", file=join, local="id", remote="id", fields=("label", ), strategy="index"),
+            JoinCSV(name="disk", file=join, local="id", remote="id", fields=("label", ), strategy="disk"),
+        ))
+
+        with mock.patch("builtins.print"), mock.patch.object(JoinCSV, "build_offset_index",
+                                                             autospec=True, side_effect=JoinCSV.build_offset_index) as build:
+            CSVMod(JoinedController(self.input, output)).start(processes=4)
+
+        self.assertEqual(["index", "disk"], [call.args[0].name for call in build.call_args_list])
+        self.assertTrue(os.path.exists(join + ".index") and os.path.exists(join + ".id.idx.sqlite"))
+        self.assertFalse([f for f in os.listdir(self.tmp.name) if f.endswith(".tmp")])
+
+        with open(output, encoding="utf-8") as f:
+            rows = list(csv.reader(f, delimiter=";"))
+
+        self.assertEqual(["1", "l1l1"], rows[2])
+        self.assertEqual(201, len(rows))
+
+
+class JoinedController(UpperController):
+    statistics = [Statistics()]
+
+    def handle(self, data):
+        data["name"] = data.join("index", "label") + data.join("disk", "label")
+
+
+class ExclaimController(Controller):
+    statistics = [Statistics()]
+    settings = dict(fields=("name", ), filter={"id": dict(prefix="1")})
+    output = dict()
+
+    def handle(self, data):
+        data["name"] = data["name"] + "!"
+
+
+class TestMultiCSVMod(FeedTestCase):
+    def test_start(self):
+        single = os.path.join(self.tmp.name, "single.csv")
+        upper = os.path.join(self.tmp.name, "upper.csv")
+        exclaim = os.path.join(self.tmp.name, "exclaim.csv")
+
+        controllers = [UpperController(self.input, upper), ExclaimController(self.input, exclaim)]
+
+        with mock.patch("builtins.print"):
+            CSVMod(UpperController(self.input, single)).start()
+            UpperController.statistics = [Statistics()]
+            MultiCSVMod(controllers).start()
+
+        with open(single) as a, open(upper) as b:
+            self.assertEqual(a.read(), b.read())
+
+        with open(exclaim) as f:
+            rows = list(csv.reader(f, delimiter=";"))
+
+        self.assertEqual(["name"], rows[0])
+        self.assertEqual(["row 1!", "row 10!", "row 11!"], [r[0] for r in rows[1:4]])
+        self.assertEqual(len([i for i in range(200) if str(i).startswith("1")]), len(rows) - 1)
+        self.assertEqual(len(rows) - 1, controllers[1].statistics[0].rows)
+        self.assertEqual(133, controllers[0].statistics[0].rows)
+        self.assertEqual(0, UpperController.statistics[0].rows)
+
+    def test_statistics(self):
+        class Upper(Controller):
+            settings = dict(fields=("id", "name"))
+
+            def handle(self, data):
+                data["name"] = data["name"].upper()
+
+        class Exclaim(Controller):
+            settings = dict(fields=("name", ), filter={"id": dict(prefix="1")})
+
+            def handle(self, data):
+                data["name"] = data["name"] + "!"
+
+        controllers = [Upper(self.input, os.path.join(self.tmp.name, "upper.csv")),
+                       Exclaim(self.input, os.path.join(self.tmp.name, "exclaim.csv"))]
+
+        with mock.patch("builtins.print") as output:
+            MultiCSVMod(controllers).start()
+
+        self.assertEqual([200, 111], [controller.statistics[0].rows for controller in controllers])
+        self.assertEqual(0, Controller.statistics[0].rows)
+        self.assertIn(mock.call("Finished, modified 200 rows."), output.call_args_list)
+
+    def test_converters(self):
+        a = CSVReadFile(file="", fields=("id", "name"), converter={"id": int})
+        b = CSVReadFile(file="", fields=("id", ), converter={"id": float})
+        a.compile(["id", "name"])
+        b.compile(["id", "name"])
+        self.assertEqual((["id", "name"], [(0, int)]), MultiCSVMod.compile([a, a]))
+        self.assertRaises(CSVError, MultiCSVMod.compile, [a, b])
+
+
+class AsyncController(Controller):
+    statistics = [Statistics()]
+    settings = dict(fields=("id", "name"))
+    output = dict()
+    concurrency = 4
+
+    active = 0
+    peak = 0
+
+    async def handle(self, data):
+        import asyncio
+
+        AsyncController.active += 1
+        AsyncController.peak = max(AsyncController.peak, AsyncController.active)
+        await asyncio.sleep((7 - int(data["id"]) % 7) / 1000)
+        AsyncController.active -= 1
+
+        if int(data["id"]) % 3 == 0:
+            return False
+
+        data["name"] = (await data.join_async("upper", "name")) if data.has_join("upper") else data["name"].upper()
+
+
+class TestAsyncCSVMod(FeedTestCase):
+    def test_start_async(self):
+        serial = os.path.join(self.tmp.name, "serial.csv")
+        output = os.path.join(self.tmp.name, "async.csv")
+
+        with mock.patch("builtins.print"):
+            CSVMod(UpperController(self.input, serial)).start()
+            AsyncCSVMod(AsyncController(self.input, output)).start()
+
+        with open(serial, encoding="utf-8") as a, open(output, encoding="utf-8") as b:
+            self.assertEqual(a.read(), b.read())
+
+        self.assertEqual(4, AsyncController.peak)
+        self.assertRaises(CSVError, AsyncCSVMod(AsyncController(self.input, output)).start, 2)
+
+    def test_join_async(self):
+        import asyncio
+
+        jmock = JoinCSVMock()
+        jmock.auto_join_async = mock.AsyncMock(return_value=jmock.test_row)
+        row = CSVRow({"foo": "bar"}, {"foo": jmock}, dict())
+
+        self.assertEqual("jbar", asyncio.run(row.join_async("foo", "jfoo")))
+        self.assertRaises(CSVError, asyncio.run, row.join_async("bar"))
+
+
+class TestCLI(TestCase):
+    def test_is_coroutine_function(self):
+        self.assertTrue(is_coroutine_function(AsyncController.handle))
+        self.assertTrue(is_coroutine_function(AsyncController().handle))
+        self.assertFalse(is_coroutine_function(UpperController().handle))
+        self.assertFalse(is_coroutine_function(len))
+
+    def test_import_controller(self):
+        self.assertIs(Controller, import_controller("csvmod.Controller"))
+        self.assertRaises(AttributeError, import_controller, "csvmod.Missing")
+
+    def test_fan_out_options(self):
+        with mock.patch("sys.stderr", new_callable=io.StringIO) as stderr:
+            with self.assertRaises(SystemExit) as e:
+                main(["csvmod.Controller", "input.csv", "output.csv", "--fan-out", "csvmod.Controller", "other.csv",
+                      "-j", "2"])
+
+        self.assertEqual(2, e.exception.code)
+        self.assertIn("parallel", stderr.getvalue())
+
+    def test_async_options(self):
+        for option in (["--checkpoint", "state"], ["--resume"], ["--incremental", "state"]):
+            with mock.patch("csvmod.import_controller", return_value=AsyncController), \
+                    mock.patch("sys.stderr", new_callable=io.StringIO) as stderr:
+                with self.assertRaises(SystemExit) as e:
+                    main(["test.AsyncController", "input.csv", "output.csv"] + option)
+
+            self.assertEqual(2, e.exception.code)
+            self.assertIn("async", stderr.getvalue())
+
+
+class IncrementalController(UpperController):
+    statistics = [Statistics()]
+    settings = dict(fields=("name", ))
+    primary_key = "id"
+    handled = 0
+
+    def handle(self, data):
+        IncrementalController.handled += 1
+        data["name"] = data["name"].upper()
+
+
+class TestIncremental(FeedTestCase):
+    def run_controller(self, output):
+        IncrementalController.handled = 0
+        with mock.patch("builtins.print"):
+            CSVMod(IncrementalController(self.input, output), incremental=self.state).start()
+
+        with open(output, encoding="utf-8") as f:
+            return f.read()
+
+    def test_incremental(self):
+        self.state = os.path.join(self.tmp.name, "state.sqlite")
+        output = os.path.join(self.tmp.name, "output.csv")
+
+        first = self.run_controller(output)
+        self.assertEqual(200, IncrementalController.handled)
+
+        self.assertEqual(first, self.run_controller(output))
+        self.assertEqual(0, IncrementalController.handled)
+
+        with open(self.input, "a", encoding="utf-8") as f:
+            f.write("200;new\n")
+
+        self.assertEqual(first + "NEW\n", self.run_controller(output))
+        self.assertEqual(1, IncrementalController.handled)
+
+        with mock.patch("csvmod.controller_signature", return_value="changed"):
+            self.run_controller(output)
+        self.assertEqual(201, IncrementalController.handled)
+
+        IncrementalController.primary_key = None
+        try:
+            self.assertRaises(CSVError, self.run_controller, output)
+        finally:
+            IncrementalController.primary_key = "id"
+
+
+class CrashingController(UpperController):
+    statistics = [Statistics()]
+    crash_at = None
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.seen = 0
+
+    def handle(self, data):
+        if int(data["id"]) == self.crash_at:
+            raise RuntimeError("crash")
+
+        self.seen += 1
+        return super().handle(data)
+
+    def get_state(self):
+        return self.seen
+
+    def set_state(self, state):
+        self.seen = state
+
+
+class TestCheckpoint(FeedTestCase):
+    def test_resume(self):
+        expected = os.path.join(self.tmp.name, "expected.csv")
+        output = os.path.join(self.tmp.name, "output.csv")
+        checkpoint = Checkpoint(os.path.join(self.tmp.name, "checkpoint"), every=40)
+
+        with mock.patch("builtins.print"):
+            CSVMod(UpperController(self.input, expected)).start()
+
+            CrashingController.crash_at = 150
+            self.assertRaises(RuntimeError, CSVMod(CrashingController(self.input, output), checkpoint=checkpoint).start)
+            self.assertTrue(os.path.exists(checkpoint.file_name))
+
+            CrashingController.crash_at = None
+            controller = CrashingController(self.input, output)
+            CSVMod(controller, checkpoint=checkpoint, resume=True).start()
+
+        with open(expected, encoding="utf-8") as a, open(output, encoding="utf-8") as b:
+            self.assertEqual(a.read(), b.read())
+
+        self.assertEqual(200, controller.seen)
+        self.assertEqual(133, controller.statistics[0].rows)
+        self.assertFalse(os.path.exists(checkpoint.file_name))
+        self.assertRaises(CSVError, CSVMod(controller, checkpoint=checkpoint, resume=True).start)
+        self.assertRaises(CSVError, CSVMod, controller, resume=True)
+
+
+class TestProfiler(FeedTestCase):
+    def test_profile(self):
+        import contextlib
+        import io
+        import json
+
+        summary = os.path.join(self.tmp.name, "profile.json")
+        stream = io.StringIO()
+        profiler = Profiler(progress=1e-9, summary=summary, stream=stream)
+        output = os.path.join(self.tmp.name, "output.csv")
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            CSVMod(UpperController(self.input, output), profiler=profiler).start()
+            UpperController.statistics = [Statistics()]
+
+        with open(summary) as f:
+            report = json.load(f)
+
+        self.assertEqual(200, report["rows"])
+        self.assertEqual(200, report["stages"]["create_row"]["calls"])
+        self.assertEqual(200 - 67, report["stages"]["write"]["calls"])
+        self.assertGreater(report["stages"]["handle"]["seconds"], 0)
+        self.assertEqual({"parse", "create_row", "handle", "statistics", "write"}, set(report["stages"]))
+        self.assertTrue(stream.getvalue().startswith("200 rows, "))
+
+        self.assertRaises(CSVError, CSVMod(UpperController(self.input, output), profiler=Profiler()).start, 2)
+
+    def test_sample(self):
+        join = os.path.join(self.tmp.name, "join.csv")
+        output = os.path.join(self.tmp.name, "output.csv")
+
+        with open(join, "w", encoding="utf-8") as f:
+            f.write("id;label\n")
+            f.writelines("%d;l%d\n" % (i, i) for i in range(200))
+
+        JoinedController.statistics = [Statistics()]
+        JoinedController.settings = dict(fields=("id", "name"), joins=(
+            JoinCSV(name="disk", file=join, local="id", remote="id", fields=("label", ), strategy="disk"),
+        ))
+        JoinedController.handle = lambda self, data: data.__setitem__("name", data.join("disk", "label"))
+        join_csv = JoinedController.settings["joins"][0]
+
+        try:
+            for run in range(2):
+                profiler = Profiler(sample=10)
+                controller = JoinedController(self.input, output)
+
+                with mock.patch("builtins.print"):
+                    CSVMod(controller, profiler=profiler).start()
+
+                report = profiler.report()
+                self.assertEqual(20, profiler.sampled)
+                self.assertEqual(200, report["stages"]["create_row"]["calls"])
+                self.assertEqual(200, report["joins"]["disk"]["calls"])
+                self.assertGreater(report["stages"]["handle"]["seconds"], 0)
+
+                # the wrapped methods are put back, so runs don't stack wrappers
+                self.assertNotIn("handle", vars(controller))
+                self.assertNotIn("create_row", vars(controller.reader))
+                self.assertNotIn("auto_join", vars(join_csv))
+        finally:
+            del JoinedController.handle
+
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+class ParquetController(UpperController):
+    statistics = [Statistics()]
+    settings = dict(fields=("id", "name"), converter={"id": int})
+    output = dict(backend="parquet", buffer_size=50)
+
+
+class TestArrowWriteFile(FeedTestCase):
+    def test_compile(self):
+        c = ArrowWriteFile(file="", fields=["a", "b"], converter={"a": comma_decimal},
+                           formatter={"a": comma_decimal_formatter, "b": str.upper})
+        c.compile(("a", "b"))
+        self.assertEqual([("a", "a", None), ("b", "b", str.upper)], c._plan)
+        self.assertEqual("float64", c._targets["a"])
+        self.assertRaises(CSVError, ArrowWriteFile, file="", backend="orc")
+        self.assertRaises(CSVError, ArrowWriteFile(file="").tell)
+
+    @unittest.skipUnless(pyarrow, "pyarrow is not installed")
+    def test_parquet(self):
+        import pyarrow.parquet
+
+        for processes in (1, 2):
+            output = os.path.join(self.tmp.name, "output%d.parquet" % processes)
+
+            with mock.patch("builtins.print"):
+                CSVMod(ParquetController(self.input, output)).start(processes)
+
+            table = pyarrow.parquet.read_table(output)
+            self.assertEqual(pyarrow.int64(), table.schema.field("id").type)
+            self.assertEqual([i for i in range(200) if i % 3], table.column("id").to_pylist())
+
+
+class TestColumnarInput(FeedTestCase):
+    def test_unsupported(self):
+        self.assertRaises(CSVError, CSVReadFile(file=self.input, backend="parquet").byte_ranges, 2)
+        self.assertRaises(CSVError, list, JoinCSV(file=self.input, backend="arrow", local="id", remote="id").records_with_offsets())
+
+    def test_converter(self):
+        c = CSVReadFile(file="", backend="parquet", fields=("price", ), converter={"price": comma_decimal},
+                        filter={"price": dict(min=4)})
+        c.compile(["price"])
+        self.assertEqual({"price": 4.9}, c.create_row([4.9]).fields)
+        self.assertEqual([4.9, 5.5], [r["price"] for r in c.create_rows([[4.9], ["5,5"]])])
+        self.assertEqual([[4.9]], list(filter(c._predicate, [[4.9], [3.9]])))
+
+    @unittest.skipUnless(pyarrow, "pyarrow is not installed")
+    def test_read(self):
+        for backend in ArrowWriteFile.backends:
+            file_name = os.path.join(self.tmp.name, "join." + backend)
+            w = ArrowWriteFile(file=file_name, backend=backend, fields=["id", "name", "size"], buffer_size=64)
+            w.begin()
+            for i in range(200):
+                w.write({"id": i, "name": "row %d" % i, "size": i * 2})
+            w.end()
+
+            c = JoinCSV(file=file_name, backend=backend, local="k", remote="id", fields=("size", ), strategy="hash")
+            c.begin()
+            self.assertEqual({"size": 84}, c.get_row(42).fields)
+            self.assertEqual({0, 2}, c.projection)
+            self.assertEqual([0, None, 0], next(iter(ColumnarReader(file_name, backend, columns={0, 2}))))
+            c.end()
+
+
+class TestBufferedWrite(TestCase):
+    def test_buffered(self):
+        for background in (True, False):
+            c = CSVWriteFile(file="", buffer_size=3, background=background)
+            c.base_csv = mock.Mock(spec=csv.DictWriter)
+            c.fields = ["foo"]
+
+            for i in range(7):
+                c.write({"foo": i, "bar": i})
+
+            c.flush()
+            self.assertEqual([[{"foo": 0}, {"foo": 1}, {"foo": 2}], [{"foo": 3}, {"foo": 4}, {"foo": 5}], [{"foo": 6}]],
+                             [call.args[0] for call in c.base_csv.writerows.call_args_list])
+            c.end()
+
+    def test_error(self):
+        c = CSVWriteFile(file="", buffer_size=1)
+        c.base_csv = mock.Mock(spec=csv.DictWriter)
+        c.base_csv.writerows.side_effect = OSError("disk full")
+        c.fields = ["foo"]
+
+        c.write({"foo": 1})
+        self.assertRaises(OSError, c.end)
+        self.assertIsNone(c._thread)
+
+    def test_close_on_error(self):
+        controller = UpperController("input", "output")
+        controller._reader = mock.Mock(spec=CSVReadFile)
+        controller._writer = mock.Mock(spec=CSVWriteFile)
+        controller.handle = mock.Mock(side_effect=ValueError)
+
+        controller._reader.rows = mock.Mock(return_value=iter([CSVRow({"id": "1", "name": "a"}, dict(), dict())]))
+        self.assertRaises(ValueError, CSVMod(controller).start)
+        controller._writer.end.assert_called_once_with()
+        controller._reader.end.assert_called_once_with()
+
+
+class TestBench(TestCase):
+    def test_make_keys(self):
+        import bench
+        import random
+
+        keys = bench.make_keys(100, 10, "zipf", "sorted", random.Random(0))
+        self.assertEqual(sorted(keys), keys)
+        self.assertTrue(all(0 <= k < 10 for k in keys))
+        self.assertEqual(sorted(list(range(10)) * 2), sorted(bench.make_keys(20, 10, "sequential", "random", random.Random(0))))
+        self.assertRaises(ValueError, bench.make_keys, 10, 10, "normal", "sorted", random.Random(0))
+
+    def test_run_benchmark(self):
+        import bench
+
+        result = bench.run_benchmark(rows=50, columns=5, join_rows=10, strategies=("hash", ), repeat=1, isolated=False)
+        scenario = result["scenarios"][0]
+
+        self.assertEqual("hash", scenario["name"])
+        self.assertFalse(bench.make_controller("feed", "join", "output", "hash").reader.joins["ref"].shared)
+        self.assertEqual(set(bench.STAGES), set(scenario["stages"]))
+        self.assertGreater(scenario["rows_per_second"], 0)
+
+        with mock.patch("builtins.print"):
+            self.assertTrue(bench.print_report(result, result))
+            slower = dict(scenarios=[dict(scenario, seconds=scenario["seconds"] / 2)])
+            self.assertFalse(bench.print_report(result, slower))
+
+
 class TestJoinCSV(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.file = os.path.join(self.tmp.name, "join.csv")
+
+        with open(self.file, "w", encoding="utf-8") as f:
+            f.write("id;sub;name\n3;a;three\n1;a;one\n2;b;two\n1;b;uno\n")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
     def test_get_row(self):
         c = JoinCSV(local="", remote="", file="")
         c.base_csv = mock.Mock(spec=csv.DictReader)
 
+    def test_hash_strategy(self):
+        c = JoinCSV(local="key", remote="id", file=self.file, fields=("id", "name"), strategy="hash")
+        c.begin()
+
+        self.assertEqual("two", c.get_row("2")["name"])
+        self.assertEqual("three", c.get_row("3")["name"])
+        self.assertEqual("one", c.get_row("1")["name"])
+        self.assertIsNone(c.get_row("4"))
+        c.end()
+
+        self.assertRaises(KeyError, JoinCSV, local="a", remote="b", file="", strategy="nope")
+
+    def test_hash_strategy_multiple(self):
+        c = JoinCSV(local=("key", "k2"), remote=("id", "sub"), file=self.file, fields=("name", ),
+                    strategy="hash", multiple=True, name="j")
+        c.begin()
+
+        self.assertEqual("uno", c.get_row(("1", "b"))["name"])
+
+        row = CSVRow({"key": "1", "k2": "a"}, {"j": c}, dict())
+        self.assertEqual(["one"], [r["name"] for r in row.join_all("j")])
+        self.assertEqual("one", row.join("j", "name"))
+        c.end()
+
+        c = JoinCSV(local="key", remote="id", file=self.file, fields=("name", ), strategy="hash", multiple=True)
+        c.begin()
+        self.assertEqual(["one", "uno"], [r["name"] for r in c.get_rows("1")])
+        self.assertEqual([], c.get_rows("5"))
+        c.end()
+
+    def test_shared_index(self):
+        def join(**kwargs):
+            nested = JoinCSV(local="name", remote="name", file=self.file, fields=("id", ), strategy="hash", name="n")
+            c = JoinCSV(local="key", remote="id", file=self.file, fields=("id", "name"), strategy="hash",
+                        joins=(nested, ), **kwargs)
+            c.begin()
+            c.end()
+            return c
+
+        a, b = join(), join()
+        self.assertIs(a.cache, b.cache)
+        self.assertEqual("2", b.get_row("2").join("n", "id"))
+        self.assertEqual(4, a.stats["scanned"])
+        self.assertEqual(0, b.stats["scanned"])
+        self.assertIsNot(a.cache, join(shared=False).cache)
+        self.assertIsNot(a.cache, join(multiple=True).cache)
+
+        with open(self.file, "a", encoding="utf-8") as f:
+            f.write("4;c;four\n")
+
+        self.assertIsNot(a.cache, join().cache)
+
+    def test_index_strategy(self):
+        index = os.path.join(self.tmp.name, "join.index")
+        c = JoinCSV(local="key", remote="id", file=self.file, fields=("name", ), index=index)
+        self.assertEqual("index", c.strategy)
+        self.assertTrue(c.build_index_file())
+        self.assertFalse(c.build_index_file())
+        c.end()
+
+        c = JoinCSV(local="key", remote="id", file=self.file, fields=("name", ), index=index, multiple=True)
+        c.begin()
+        self.assertEqual(["one", "uno"], [r["name"] for r in c.get_rows("1")])
+        self.assertEqual("three", c.get_row("3")["name"])
+        self.assertIsNone(c.get_row("0"))
+        self.assertIsNone(c.get_row("4"))
+        self.assertEqual(3, c.stats["scanned"])
+        c.end()
+
+        c = JoinCSV(local=("key", "k2"), remote=("id", "sub"), file=self.file, fields=("name", ), index=index,
+                    converter={"id": int}, filter={"name": dict(prefix="u")})
+        c.begin()
+        self.assertEqual("uno", c.get_row((1, "b"))["name"])
+        self.assertIsNone(c.get_row((1, "a")))
+        c.end()
+
+    def test_disk_strategy(self):
+        index = os.path.join(self.tmp.name, "join.idx")
+        c = JoinCSV(local=("key", "k2"), remote=("id", "sub"), file=self.file, fields=("name", ),
+                    strategy="disk", disk_index=index)
+        c.begin()
+        self.assertEqual("uno", c.get_row(("1", "b"))["name"])
+        self.assertEqual("three", c.get_row(("3", "a"))["name"])
+        self.assertIsNone(c.get_row(("3", "b")))
+        c.end()
+
+        c = JoinCSV(local="key", remote="id", file=self.file, fields=("name", ), strategy="disk",
+                    converter={"id": int}, multiple=True)
+        c.begin()
+        self.assertEqual(["one", "uno"], [r["name"] for r in c.get_rows(1)])
+        self.assertEqual("two", c.get_row(2)["name"])
+        c.end()
+
+        with mock.patch("csv.reader", side_effect=AssertionError("index rebuilt")):
+            c.begin()
+            c.end()
+
+        c = JoinCSV(local="key", remote="id", file=self.file, fields=("name", ), strategy="disk")
+        names = JoinCSV(local="key", remote="name", file=self.file, fields=("id", ), strategy="disk")
+        c.begin()
+        names.begin()
+        self.assertEqual("one", c.get_row("1")["name"])
+        self.assertIsNone(c.get_row("one"))
+        self.assertEqual("1", names.get_row("one")["id"])
+        self.assertNotEqual(c.disk_index, names.disk_index)
+        c.end()
+        names.end()
+
+    def test_cache_size(self):
+        c = JoinCSV(local="key", remote="id", file=self.file, fields=("name", ), cache_size=2)
+        c.begin()
+        self.assertEqual("two", c.get_row("2")["name"])
+        self.assertEqual(["1", "2"], list(c.cache.keys()))
+        self.assertEqual(1, c.stats["evictions"])
+        self.assertEqual("one", c.get_row("1")["name"])
+        self.assertEqual(["2", "1"], list(c.cache.keys()))
+        self.assertEqual(1, c.stats["hits"])
+        self.assertEqual(1, c.stats["misses"])
+        self.assertEqual(3, c.stats["scanned"])
+        c.end()
+
+        c = JoinCSV(local="key", remote="id", file=self.file, fields=("name", ), cache_size=2)
+        c.begin()
+        self.assertEqual("two", c.get_row("2")["name"])
+        self.assertNotIn("3", c.cache)
+        self.assertEqual("three", c.get_row("3")["name"])
+        self.assertIsNone(c.get_row("4"))
+        c.end()
+
+        c = JoinCSV(local="key", remote="id", file=self.file, fields=("name", ), strategy="disk",
+                    disk_index=os.path.join(self.tmp.name, "join.idx"), cache_size=1)
+        c.begin()
+        c.get_row("1")
+        c.get_row("1")
+        c.get_row("2")
+        self.assertEqual(["2"], list(c.cache.keys()))
+        self.assertEqual((1, 2, 1, 2), (c.stats["hits"], c.stats["misses"], c.stats["evictions"], c.stats["scanned"]))
+        c.end()
+
+        self.assertEqual(JoinCSV.disk_cache_size, JoinCSV(local="key", remote="id", file=self.file, index="x").cache_size)
+        self.assertIsNone(JoinCSV(local="key", remote="id", file=self.file, strategy="disk", cache_size=None).cache_size)
+
+    def test_merge_strategy(self):
+        with open(self.file, "w", encoding="utf-8") as f:
+            f.write("id;name\n1;one\n1;uno\n3;three\n4;four\n")
+
+        c = JoinCSV(local="key", remote="id", file=self.file, fields=("name", ), strategy="merge", multiple=True)
+        c.begin()
+        self.assertEqual(["one", "uno"], [r["name"] for r in c.get_rows("1")])
+        self.assertEqual("one", c.get_row("1")["name"])
+        self.assertIsNone(c.get_row("2"))
+        self.assertEqual("four", c.get_row("4")["name"])
+        self.assertRaises(CSVError, c.get_row, "3")
+        c.end()
+
+        with open(self.file, "w", encoding="utf-8") as f:
+            f.write("id;name\n1;one\n3;three\n2;two\n")
+
+        c = JoinCSV(local="key", remote="id", file=self.file, fields=("name", ), strategy="merge")
+        c.begin()
+        self.assertRaises(CSVError, c.get_row, "4")
+        c.end()
+
+        c = JoinCSV(local="key", remote="id", file=self.file, fields=("name", ), strategy="merge", validate=False)
+        c.begin()
+        self.assertEqual("three", c.get_row("3")["name"])
+        self.assertIsNone(c.get_row("2"))
+        c.end()
+
 
 if __name__ == "__main__":
     unittest.main()